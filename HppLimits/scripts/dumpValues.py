@@ -5,7 +5,10 @@ import math
 import json
 import pickle
 import errno
-import ROOT
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from rootLoader import getROOT
 
 # helper functions
 def python_mkdir(dir):
@@ -23,16 +26,70 @@ def dumpResults(results,name):
     pfile = '{0}.pkl'.format(name)
     if os.path.dirname(jfile): python_mkdir(os.path.dirname(jfile))
     if os.path.dirname(pfile): python_mkdir(os.path.dirname(pfile))
-    with open(jfile,'w') as f:
+    # write to a temporary file and rename so a crash never leaves a corrupt file
+    with open(jfile+'.tmp','w') as f:
         f.write(json.dumps(results, indent=4, sort_keys=True))
-    with open(pfile,'wb') as f:
+    os.rename(jfile+'.tmp',jfile)
+    with open(pfile+'.tmp','wb') as f:
         pickle.dump(results,f)
+    os.rename(pfile+'.tmp',pfile)
+
+
+class ResultStore(object):
+    '''
+    Append-only JSON-lines store of results keyed by (analysis, mode, mass, channel).
+    Each mass point is appended and synced as one write, so a crash loses at most
+    the point in progress. Later records override earlier ones on load.
+    '''
+    def __init__(self,name):
+        self.fileName = '{0}.jsonl'.format(name)
+        if os.path.dirname(self.fileName): python_mkdir(os.path.dirname(self.fileName))
+
+    def load(self):
+        results = {}
+        if not os.path.isfile(self.fileName): return results
+        with open(self.fileName,'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # partial line from an interrupted write
+                    continue
+                results[(record['analysis'],record['mode'],record['mass'],record['channel'])] = record['values']
+        return results
+
+    def append(self,analysis,mode,mass,allVals):
+        lines = ''
+        for chan in sorted(allVals):
+            record = {'analysis': analysis, 'mode': mode, 'mass': mass, 'channel': chan, 'values': allVals[chan]}
+            lines += json.dumps(record, sort_keys=True)+'\n'
+        with open(self.fileName,'a+') as f:
+            # terminate a partial line left by an interrupted write
+            f.seek(0,os.SEEK_END)
+            if f.tell():
+                f.seek(-1,os.SEEK_END)
+                if f.read(1)!='\n': lines = '\n'+lines
+            f.seek(0,os.SEEK_END)
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        if os.path.isfile(self.fileName): os.remove(self.fileName)
+
+    def compact(self,name):
+        '''Write the nested json and pickle from the store'''
+        data = {}
+        for (analysis,mode,mass,chan),vals in self.load().iteritems():
+            data.setdefault(analysis,{}).setdefault(mode,{}).setdefault(mass,{})[chan] = vals
+        dumpResults(data,name)
+        return data
 
 
 def printObjects(workspace,func):
     print func
     args = getattr(workspace,func)()
-    if isinstance(args,ROOT.RooArgSet):
+    if isinstance(args,getROOT().RooArgSet):
         args.Print()
     else:
         for arg in args:
@@ -54,28 +111,45 @@ def getArgsetMap(workspace,func):
         var = it.Next()
     return allVars
 
-def getVals(allFuncs,doSB=False, channels=[]):
-    apMap = {}
-    ppMap = {}
-    bgMap = {}
-    hpps = {
-        'll' : ['ee','em','mm'],
-        'el' : ['ee','em'],
-        'ml' : ['em','mm'],
-        'ee' : ['ee'],
-        'em' : ['em'],
-        'mm' : ['mm'],
-        'lt' : ['et','mt'],
-        'et' : ['et'],
-        'mt' : ['mt'],
-        'tt' : ['tt']
-    }
-    hms = {
-        'l' : ['e','m'],
-        'e' : ['e'],
-        'm' : ['m'],
-        't' : ['t'],
-    }
+def getDependencyIndex(funcs,varNames):
+    '''
+    Map each of varNames to the indices of the functions whose value depends
+    on it, from the variables of each function in the RooFit server graph.
+    '''
+    ROOT = getROOT()
+    index = dict([(v,[]) for v in varNames])
+    for i,f in enumerate(funcs):
+        deps = f.getVariables()
+        ROOT.SetOwnership(deps,True)
+        it = deps.createIterator()
+        var = it.Next()
+        while var:
+            name = var.GetName()
+            if name in index: index[name].append(i)
+            var = it.Next()
+    return dict([(v,np.array(idx,dtype=int)) for v,idx in index.iteritems()])
+
+hpps = {
+    'll' : ['ee','em','mm'],
+    'el' : ['ee','em'],
+    'ml' : ['em','mm'],
+    'ee' : ['ee'],
+    'em' : ['em'],
+    'mm' : ['mm'],
+    'lt' : ['et','mt'],
+    'et' : ['et'],
+    'mt' : ['mt'],
+    'tt' : ['tt']
+}
+hms = {
+    'l' : ['e','m'],
+    'e' : ['e'],
+    'm' : ['m'],
+    't' : ['t'],
+}
+
+def expandChannels(channels):
+    '''Expand channel specs (e.g. 'ltlt') into all final state channels'''
     allChannels = []
     for chan in channels:
         if len(chan) == 3:
@@ -90,96 +164,177 @@ def getVals(allFuncs,doSB=False, channels=[]):
             for i in hpps[hpp]:
                 for j in hpps[hmm]:
                     allChannels += [i+j]
-    for f,v in allFuncs.iteritems():
-        if channels and not any(['_{0}_'.format(c) in f for c in allChannels]): continue
-        if doSB and 'SB' not in f: continue
-        if not doSB and 'SB' in f: continue
-        if 'datadriven' in f:
-            bgMap[f] = v.getVal()
-        elif 'HppHmm' in f:
-            ppMap[f] = v.getVal()
-        else:
-            apMap[f] = v.getVal()
-    return apMap, ppMap, bgMap
-
-def getUncertainty(expMap,shiftMap):
-    total = 0.
-    totalShift = 0.
-    for f in expMap:
-        total += expMap[f]
-        totalShift += shiftMap[f]
-    unc = abs(total-totalShift)/total if total else 0.
-    return unc
-
-def varyNuisances(allVars, allFuncs, doSB=False,channels=[]):
-    # get unvaried expected for each channel
-    apMap, ppMap, bgMap = getVals(allFuncs,doSB=doSB,channels=channels)
-    ap = sum([v for f,v in apMap.iteritems()])
-    pp = sum([v for f,v in ppMap.iteritems()])
-    bg = sum([v for f,v in bgMap.iteritems()])
-    # vary each nuisance independently and get change in expected
-    apVaryMap = {'up':{}, 'down':{}}
-    ppVaryMap = {'up':{}, 'down':{}}
-    bgVaryMap = {'up':{}, 'down':{}}
-    for f,v in allVars.iteritems():
-        # remove stuff that isnt an uncertainty
-        if '_In' in f: continue
-        if 'CMS_fake' in f: continue
-        if f in ['r','MH']: continue
-
-        if 'alpha_13TeV80X' in f:
-            # vary gmN
-            start = v.getVal()
-            uperr = start*(1 + 1/math.sqrt(start+1))
-            downerr = start*(1 - 1/math.sqrt(start+1))
-            v.setVal(uperr)
-            apVaryMap['up'][f], ppVaryMap['up'][f], bgVaryMap['up'][f] = getVals(allFuncs,doSB=doSB,channels=channels)
-            v.setVal(downerr)
-            apVaryMap['down'][f], ppVaryMap['down'][f], bgVaryMap['down'][f] = getVals(allFuncs,doSB=doSB,channels=channels)
-            v.setVal(start)
-        else:
-            # vary lnN
-            v.setVal(1.)
-            apVaryMap['up'][f], ppVaryMap['up'][f], bgVaryMap['up'][f] = getVals(allFuncs,doSB=doSB,channels=channels)
-            v.setVal(-1.)
-            apVaryMap['down'][f], ppVaryMap['down'][f], bgVaryMap['down'][f] = getVals(allFuncs,doSB=doSB,channels=channels)
-            v.setVal(0.)
-    # sum of squares the changes
-    apErr2 = {'up':0.,'down':0.}
-    ppErr2 = {'up':0.,'down':0.}
-    bgErr2 = {'up':0.,'down':0.}
-    for f in allVars:
-        if f not in bgVaryMap['up']: continue
-        apErr2['up'] += getUncertainty(apMap,apVaryMap['up'][f])**2
-        ppErr2['up'] += getUncertainty(ppMap,ppVaryMap['up'][f])**2
-        bgErr2['up'] += getUncertainty(bgMap,bgVaryMap['up'][f])**2
-        apErr2['down'] += getUncertainty(apMap,apVaryMap['down'][f])**2
-        ppErr2['down'] += getUncertainty(ppMap,ppVaryMap['down'][f])**2
-        bgErr2['down'] += getUncertainty(bgMap,bgVaryMap['down'][f])**2
-    return ap, pp, bg, ap*apErr2['up']**0.5, pp*ppErr2['up']**0.5, bg*bgErr2['up']**0.5, ap*apErr2['down']**0.5, pp*ppErr2['down']**0.5, bg*bgErr2['down']**0.5
-
-def getCardValues(analysis,mode,mass,channels=[]):
-    filename = 'working/{0}/{1}/higgsCombineTest.Asymptotic.mH{2}.root'.format(analysis,mode,mass)
-    tfile = ROOT.TFile(filename)
-    
-    ROOT.gSystem.Load("libHiggsAnalysisCombinedLimit")
-    
-    workspace = tfile.Get("w")
-    
-    allVars = getArgsetMap(workspace,'allVars')
-    allPdfs = getArgsetMap(workspace,'allPdfs')
-    allFuncs = getArgsetMap(workspace,'allFunctions')
-    
-    #print 'vars'
-    #printDict(allVars)
-    #print 'pdfs'
-    #printDict(allPdfs)
-    #print 'functions'
-    #printDict(allFuncs)
-    #print 'vars', len(allVars), 'pdfs', len(allPdfs), 'functions', len(allFuncs)
+    return allChannels
+
+_expanded = {}
+def getExpandedChannels(channels):
+    '''Memoized expandChannels for a channel spec'''
+    key = tuple(channels)
+    if key not in _expanded: _expanded[key] = frozenset(expandChannels(channels))
+    return _expanded[key]
+
+class ChannelIndex(object):
+    '''
+    Inverted index of the function names of a workspace, built once.
+
+    Each name is split on '_' and every inner token (e.g. the 'eeee' of
+    n_exp_binHpp4l_eeee_proc_...) maps to the indices of the functions
+    containing it, so that a channel selection is a union of set lookups.
+    The SR/SB and AP/PP/background classification is stored alongside.
+    '''
+    def __init__(self,funcNames):
+        self.funcNames = list(funcNames)
+        self.tokens = {}
+        for i,f in enumerate(self.funcNames):
+            # '_{c}_' in f <=> c is an inner token of f
+            for t in set(f.split('_')[1:-1]):
+                self.tokens.setdefault(t,set()).add(i)
+        self.isSB = np.array(['SB' in f for f in self.funcNames],dtype=bool)
+        self.process = np.array([BG if 'datadriven' in f else PP if 'HppHmm' in f else AP for f in self.funcNames],dtype=int)
+        self.regions = {
+            True  : set(np.nonzero(self.isSB)[0]),
+            False : set(np.nonzero(~self.isSB)[0]),
+        }
+        self.selections = {}
+
+    def select(self,doSB=False,channels=[]):
+        '''Sorted indices of the functions in the SR/SB for the given channels'''
+        key = (doSB,tuple(channels))
+        if key not in self.selections:
+            selected = self.regions[doSB]
+            if channels:
+                inChannel = set()
+                for c in getExpandedChannels(channels):
+                    inChannel |= self.tokens.get(c,set())
+                selected = selected & inChannel
+            self.selections[key] = np.array(sorted(selected),dtype=int)
+        return self.selections[key]
+
+def isNuisance(var):
+    '''Remove stuff that isnt an uncertainty'''
+    if '_In' in var: return False
+    if 'CMS_fake' in var: return False
+    if var in ['r','MH']: return False
+    return True
+
+# process indices
+AP, PP, BG = 0, 1, 2
+
+class NuisanceEngine(object):
+    '''
+    Vectorized nuisance variations for a workspace.
+
+    The functions are classified once into index arrays, and each nuisance
+    is shifted up and down once, storing the yields of every function in
+    dense (nuisance x function) matrices. Any SR/SB and channel selection
+    is then a reduction over those matrices.
+
+    A shift only re-evaluates the functions depending on the nuisance
+    (from the dependency index), all others keep their nominal value.
+    '''
+    def __init__(self,allVars,allFuncs):
+        self.funcNames = sorted(allFuncs)
+        self.funcs = [allFuncs[f] for f in self.funcNames]
+        self.channelIndex = ChannelIndex(self.funcNames)
+        self.isSB = self.channelIndex.isSB
+        self.process = self.channelIndex.process
+        self.nuisNames = [v for v in sorted(allVars) if isNuisance(v)]
+        self.nuisVars = [allVars[v] for v in self.nuisNames]
+        self.index = None
+        self.nominal = None
+        self.up = None
+        self.down = None
+
+    def getValues(self):
+        return np.array([f.getVal() for f in self.funcs],dtype=float)
 
-    apValSR, ppValSR, bgValSR, apErrUpSR, ppErrUpSR, bgErrUpSR, apErrDownSR, ppErrDownSR, bgErrDownSR = varyNuisances(allVars, allFuncs, doSB=False,channels=channels)
-    apValSB, ppValSB, bgValSB, apErrUpSB, ppErrUpSB, bgErrUpSB, apErrDownSB, ppErrDownSB, bgErrDownSB = varyNuisances(allVars, allFuncs, doSB=True,channels=channels)
+    def getShifted(self,nominal,idx):
+        '''The nominal values with the functions in idx re-evaluated'''
+        vals = nominal.copy()
+        vals[idx] = [self.funcs[j].getVal() for j in idx]
+        return vals
+
+    def evaluate(self):
+        '''Evaluate the nominal and shifted yields (only done once)'''
+        if self.nominal is not None: return
+        if self.index is None: self.index = getDependencyIndex(self.funcs,self.nuisNames)
+        nominal = self.getValues()
+        up = np.empty((len(self.nuisVars),len(self.funcs)),dtype=float)
+        down = np.empty((len(self.nuisVars),len(self.funcs)),dtype=float)
+        for i,(n,v) in enumerate(zip(self.nuisNames,self.nuisVars)):
+            idx = self.index[n]
+            if 'alpha_13TeV80X' in n:
+                # vary gmN
+                start = v.getVal()
+                v.setVal(start*(1 + 1/math.sqrt(start+1)))
+                up[i] = self.getShifted(nominal,idx)
+                v.setVal(start*(1 - 1/math.sqrt(start+1)))
+                down[i] = self.getShifted(nominal,idx)
+                v.setVal(start)
+            else:
+                # vary lnN
+                v.setVal(1.)
+                up[i] = self.getShifted(nominal,idx)
+                v.setVal(-1.)
+                down[i] = self.getShifted(nominal,idx)
+                v.setVal(0.)
+        self.nominal, self.up, self.down = nominal, up, down
+
+    def getSelection(self,doSB=False,channels=[]):
+        '''Boolean mask of the functions in the SR/SB for the given channels'''
+        mask = np.zeros(len(self.funcNames),dtype=bool)
+        mask[self.channelIndex.select(doSB=doSB,channels=channels)] = True
+        return mask
+
+    def getYields(self,doSB=False,channels=[]):
+        '''Return (ap, pp, bg) yields with up and down uncertainties'''
+        self.evaluate()
+        mask = self.getSelection(doSB=doSB,channels=channels)
+        # (function x process) projection onto ap, pp, bg
+        proj = np.zeros((len(self.funcs),3),dtype=float)
+        proj[np.nonzero(mask)[0],self.process[mask]] = 1.
+        total = self.nominal.dot(proj)
+        vals = [total]
+        for shifted in [self.up, self.down]:
+            totalShift = shifted.dot(proj)
+            unc = np.zeros_like(totalShift)
+            np.divide(np.abs(total-totalShift),total,out=unc,where=(total!=0))
+            vals += [total*np.sqrt((unc**2).sum(axis=0))]
+        return tuple(float(x) for v in vals for x in v)
+
+def getWorkspaceFilename(analysis,mode,mass):
+    return 'working/{0}/{1}/higgsCombineTest.Asymptotic.mH{2}.root'.format(analysis,mode,mass)
+
+class WorkspaceSession(object):
+    '''
+    A workspace loaded once, with its name maps and nuisance engine, to be
+    shared by all channel groups and SR/SB computations for a mass point.
+    '''
+    def __init__(self,filename):
+        ROOT = getROOT(combine=True)
+        self.filename = filename
+        self.tfile = ROOT.TFile(filename)
+        self.workspace = self.tfile.Get("w")
+        self.allVars = getArgsetMap(self.workspace,'allVars')
+        self.allPdfs = getArgsetMap(self.workspace,'allPdfs')
+        self.allFuncs = getArgsetMap(self.workspace,'allFunctions')
+        self.engine = NuisanceEngine(self.allVars, self.allFuncs)
+
+        #print 'vars'
+        #printDict(self.allVars)
+        #print 'pdfs'
+        #printDict(self.allPdfs)
+        #print 'functions'
+        #printDict(self.allFuncs)
+        #print 'vars', len(self.allVars), 'pdfs', len(self.allPdfs), 'functions', len(self.allFuncs)
+
+    def close(self):
+        self.tfile.Close()
+
+def getCardValues(session,channels=[]):
+    engine = session.engine
+    apValSR, ppValSR, bgValSR, apErrUpSR, ppErrUpSR, bgErrUpSR, apErrDownSR, ppErrDownSR, bgErrDownSR = engine.getYields(doSB=False,channels=channels)
+    apValSB, ppValSB, bgValSB, apErrUpSB, ppErrUpSB, bgErrUpSB, apErrDownSB, ppErrDownSB, bgErrDownSB = engine.getYields(doSB=True,channels=channels)
 
     return {
         'apSR': {'val': apValSR, 'errUp': apErrUpSR, 'errDown': apErrDownSR,},
@@ -189,12 +344,20 @@ def getCardValues(analysis,mode,mass,channels=[]):
         'ppSB': {'val': ppValSB, 'errUp': ppErrUpSB, 'errDown': ppErrDownSB,},
         'bgSB': {'val': bgValSB, 'errUp': bgErrUpSB, 'errDown': bgErrDownSB,},
     }
+
+def getMassValues(analysis,mode,mass,channels):
+    '''Get the values for all channel groups of a mass point from one workspace load'''
+    session = WorkspaceSession(getWorkspaceFilename(analysis,mode,mass))
+    allVals = {}
+    for chan in sorted(channels):
+        print analysis,mode,mass,chan
+        allVals[chan] = getCardValues(session,channels=channels[chan])
+    session.close()
+    return allVals
     
 
 analyses = ['Hpp3lAP','Hpp3lPP','Hpp4l','HppAP','HppPP','HppComb']
-analyses = ['HppComb']
 modes = ['ee100','em100','et100','mm100','mt100','tt100','BP1','BP2','BP3','BP4']
-modes = ['ee100','em100','et100','mm100','mt100','tt100']
 masses = [200,300,400,500,600,700,800,900,1000,1100,1200,1300,1400,1500]
 
 channels = {
@@ -206,18 +369,78 @@ channels = {
     'tt100' : {'lll': ['lll'], 'llt': ['llt'], 'ltl': ['ltl'], 'ltt': ['ltt'], 'ttl': ['ttl'], 'ttt': ['ttt'],  'llll': ['llll'], 'lllt': ['lllt'], 'lltt': ['lltt'], 'ltlt': ['ltlt'], 'lttt': ['lttt'], 'tttt': ['tttt']},
 }
 
-analyses = ['HppComb']
-#modes = ['ee100']
-#masses = [200]
-data = {}
-for analysis in analyses:
-    data[analysis] = {}
-    for mode in modes:
-        data[analysis][mode] = {}
-        for mass in masses:
-            allVals = {}
-            for chan in sorted(channels[mode]):
-                print analysis,mode,mass,chan
-                allVals[chan] = getCardValues(analysis,mode,mass,channels=channels[mode][chan])
-            data[analysis][mode][mass] = allVals
-            dumpResults(data,'limit_uncertainties')
+def valuesWrapper(args):
+    '''
+    Compute all channel groups of an (analysis, mode, mass) point.
+    The channels of a mass point share the nuisance shifts of one workspace,
+    so they are processed together in a single worker.
+    '''
+    analysis, mode, mass = args
+    return analysis, mode, mass, getMassValues(analysis,mode,mass,channels[mode])
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Dump yields and uncertainties from workspaces')
+
+    parser.add_argument('-a','--analyses', nargs='+',type=str,default=['HppComb'],choices=analyses,help='Analyses to process')
+    parser.add_argument('-bp','--modes', nargs='+',type=str,default=['ee100','em100','et100','mm100','mt100','tt100'],choices=sorted(channels),help='Branching points to process')
+    parser.add_argument('-m','--masses', nargs='+',type=int,default=masses,help='Masses to process')
+    parser.add_argument('-o','--output', type=str,default='limit_uncertainties',help='Output name (without extension)')
+    parser.add_argument('--compact',action='store_true',help='Only write the json and pickle from the stored results')
+    parser.add_argument('--fresh',action='store_true',help='Discard stored results instead of resuming')
+    parser.add_argument('-j',type=int,default=1,help='Number of cores')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    store = ResultStore(args.output)
+    if args.compact:
+        store.compact(args.output)
+        return 0
+    if args.fresh: store.clear()
+
+    # resume from the points already stored
+    stored = store.load()
+    tasks = []
+    for analysis in args.analyses:
+        for mode in args.modes:
+            for mass in args.masses:
+                if all([(analysis,mode,mass,chan) in stored for chan in channels[mode]]): continue
+                tasks += [(analysis,mode,mass)]
+    if stored: print 'Resuming: {0} of {1} points to process'.format(len(tasks),len(args.analyses)*len(args.modes)*len(args.masses))
+
+    if args.j>1 and tasks:
+        # load ROOT and combine before forking, each worker then only loads its workspaces
+        getROOT(combine=True)
+        p = Pool(args.j)
+        results = p.imap_unordered(valuesWrapper, tasks)
+    else:
+        p = None
+        results = (valuesWrapper(task) for task in tasks)
+
+    try:
+        for analysis, mode, mass, allVals in results:
+            store.append(analysis,mode,mass,allVals)
+    except KeyboardInterrupt:
+        if p: p.terminate()
+        print 'dump cancelled'
+        return 1
+
+    if p:
+        p.close()
+        p.join()
+
+    store.compact(args.output)
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''
+A single SQLite table of the asymptotic and fullCLs limits, one row per
+(analysis, mode, mass, prod, method), next to the limits{prod}.txt files.
+
+Loading a whole sweep is one query returning numpy arrays:
+
+    from limitStore import LimitStore
+    store = LimitStore('limits.db')
+    data = store.load(analysis='HppComb',method='asymptotic')
+    data['mass'], data['limits'][:,2]  # masses and median expected
+'''
+import os
+import sys
+import glob
+import errno
+import argparse
+import sqlite3
+import time
+import numpy as np
+
+# columns of the six quantiles in the order written by combine
+quantiles = ['exp0p025','exp0p160','exp0p500','exp0p840','exp0p975','obs']
+methods = ['asymptotic','fullCLs']
+
+StoreError = sqlite3.Error
+
+def python_mkdir(dir):
+    '''A function to make a unix directory as well as subdirectories'''
+    try:
+        os.makedirs(dir)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(dir):
+            pass
+        else: raise
+
+def getDefaultStore():
+    return os.path.join(os.environ['CMSSW_BASE'],'src','limits.db')
+
+class LimitStore(object):
+    '''SQLite table of limits, safe to update from several processes'''
+    def __init__(self,filename=''):
+        self.filename = filename if filename else getDefaultStore()
+        if os.path.dirname(self.filename): python_mkdir(os.path.dirname(self.filename))
+        self.conn = sqlite3.connect(self.filename,timeout=60)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS limits ('
+                'analysis TEXT, mode TEXT, mass INTEGER, prod TEXT, method TEXT, '
+                + ', '.join(['{0} REAL'.format(q) for q in quantiles]) +
+                ', updated REAL, PRIMARY KEY (analysis, mode, mass, prod, method))'
+            )
+
+    def write(self,analysis,mode,mass,prod,method,limits):
+        '''Insert or replace the limits of a point, missing quantiles are stored as NULL'''
+        limits = list(limits)[:len(quantiles)]
+        limits += [None]*(len(quantiles)-len(limits))
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO limits VALUES ({0})'.format(', '.join(['?']*(len(quantiles)+6))),
+                [analysis,mode,int(mass),prod,method]+limits+[time.time()]
+            )
+
+    def load(self,analysis=None,mode=None,prod=None,method=None):
+        '''
+        Load the matching rows, sorted by (analysis, mode, prod, method, mass).
+        Returns a dict of numpy arrays for the key columns, and 'limits'
+        as an (N x 6) array with NaN for missing quantiles.
+        '''
+        selection = [(k,v) for k,v in [('analysis',analysis),('mode',mode),('prod',prod),('method',method)] if v is not None]
+        query = 'SELECT analysis, mode, mass, prod, method, {0} FROM limits'.format(', '.join(quantiles))
+        if selection:
+            query += ' WHERE ' + ' AND '.join(['{0} = ?'.format(k) for k,v in selection])
+        query += ' ORDER BY analysis, mode, prod, method, mass'
+        rows = self.conn.execute(query,[v for k,v in selection]).fetchall()
+        data = {
+            'analysis' : np.array([r[0] for r in rows],dtype=str),
+            'mode'     : np.array([r[1] for r in rows],dtype=str),
+            'mass'     : np.array([r[2] for r in rows],dtype=int),
+            'prod'     : np.array([r[3] for r in rows],dtype=str),
+            'method'   : np.array([r[4] for r in rows],dtype=str),
+            'limits'   : np.array([[np.nan if x is None else x for x in r[5:]] for r in rows],dtype=float).reshape(len(rows),len(quantiles)),
+        }
+        return data
+
+    def close(self):
+        self.conn.close()
+
+def recordLimits(analysis,mode,mass,prod,method,limits,filename=''):
+    '''Add the limits of a finished point to the store'''
+    store = LimitStore(filename)
+    try:
+        store.write(analysis,mode,mass,prod,method,limits)
+    finally:
+        store.close()
+
+def importLimits(store,srcdir):
+    '''Fill the store from the existing {method}/{analysis}/{mode}/{mass}/limits{prod}.txt files'''
+    n = 0
+    for method in methods:
+        for fname in glob.glob(os.path.join(srcdir,method,'*','*','*','limits*.txt')):
+            mdir, base = os.path.split(fname)
+            analysis, mode, mass = mdir.split(os.sep)[-3:]
+            prod = base[len('limits'):-len('.txt')]
+            try:
+                with open(fname,'r') as f:
+                    limits = [float(x) for x in f.readline().split()]
+                store.write(analysis,mode,int(mass),prod,method,limits)
+            except ValueError:
+                print 'Skipping {0}'.format(fname)
+                continue
+            n += 1
+    return n
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Build and query the limit store')
+
+    parser.add_argument('-s','--store',type=str,default='',help='Store file (default: $CMSSW_BASE/src/limits.db)')
+    parser.add_argument('--import',dest='importDir',nargs='?',type=str,const='',default=None,help='Import the limits text files under this directory (default: $CMSSW_BASE/src)')
+    parser.add_argument('-a','--analysis',type=str,default=None,help='Analysis to print')
+    parser.add_argument('-bp','--mode',type=str,default=None,help='Branching point to print')
+    parser.add_argument('--method',type=str,default=None,choices=methods,help='Method to print')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    store = LimitStore(args.store)
+
+    if args.importDir is not None:
+        srcdir = args.importDir if args.importDir else os.path.join(os.environ['CMSSW_BASE'],'src')
+        print 'Imported {0} limits'.format(importLimits(store,srcdir))
+        return 0
+
+    data = store.load(analysis=args.analysis,mode=args.mode,method=args.method)
+    print ' '.join(['{0:10}'.format(x) for x in ['analysis','mode','mass','prod','method']+quantiles])
+    for i in range(len(data['mass'])):
+        print ' '.join(['{0:10}'.format(data[k][i]) for k in ['analysis','mode','mass','prod','method']]+['{0:10.4g}'.format(x) for x in data['limits'][i]])
+    store.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
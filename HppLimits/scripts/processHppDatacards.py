@@ -15,15 +15,30 @@ import socket
 import signal
 import logging
 import math
-import ROOT
+import hashlib
+import shutil
+import time
+import pipes
+import json
+import threading
+import tempfile
+import Queue
+import resubmitLimits
+import limitStore
 import subprocess
+import numpy as np
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from socket import gethostname
+from rootLoader import getROOT
 
 masses = [200, 300, 400, 500, 600, 700, 800, 900, 1000, 1100, 1200, 1300, 1400, 1500]
 
 scratchDir = 'data' if 'uwlogin' in gethostname() else 'nfs_scratch'
 
+# asymptotic result cache, relative to $CMSSW_BASE/src
+cacheDir = 'cache/asymptotic'
+
 def python_mkdir(dir):
     '''A function to make a unix directory as well as subdirectories'''
     try:
@@ -33,274 +48,1512 @@ def python_mkdir(dir):
             pass
         else: raise
 
-def limitsWrapper(args):
-    getLimits(*args)
+class CommandError(Exception):
+    '''A command failed to start or exited with a non-zero status'''
+    def __init__(self,result):
+        self.result = result
+        Exception.__init__(self,'Command failed with status {0} (log: {1}): {2}'.format(result.returncode,result.log,result.commandString()))
+
+class StageError(Exception):
+    '''A stage finished without a usable result, so the nodes depending on it must not run'''
+
+class CommandResult(object):
+    '''Exit status and resource usage of a finished command'''
+    def __init__(self,command,cwd,log,returncode,wall,cpu,maxrss):
+        self.command = command
+        self.cwd = cwd
+        self.log = log
+        self.returncode = returncode
+        self.wall = wall
+        self.cpu = cpu
+        self.maxrss = maxrss
+
+    def commandString(self):
+        return ' '.join([pipes.quote(x) for x in self.command])
+
+def runCommand(command,cwd=None,log=None,stdout=None,check=True,env=None):
+    '''
+    Run a command (an argv list, no shell) in cwd, with env as the environment if given.
+    stdout and stderr are streamed to the log file (appended, or discarded if no log),
+    stdout can instead be redirected to a file.
+    Returns a CommandResult with the exit status, wall and cpu time, and peak RSS (kB).
+    Raises CommandError on failure if check.
+    '''
+    command = [str(x) for x in command]
+    if log: python_mkdir(os.path.dirname(log))
+    logfile = open(log,'a') if log else open(os.devnull,'w')
+    outfile = open(stdout,'w') if stdout else logfile
+    start = time.time()
+    try:
+        if log:
+            logfile.write('# {0}\n# cwd: {1}\n'.format(' '.join([pipes.quote(x) for x in command]),cwd or os.getcwd()))
+            logfile.flush()
+        try:
+            proc = subprocess.Popen(command,cwd=cwd,stdout=outfile,stderr=logfile,close_fds=True,env=env)
+        except OSError as e:
+            logfile.write('# failed to start: {0}\n'.format(e))
+            result = CommandResult(command,cwd,log,127,time.time()-start,0.,0)
+        else:
+            # wait4 gives the resource usage of this child alone
+            pid, status, usage = os.wait4(proc.pid,0)
+            returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            proc.returncode = returncode
+            result = CommandResult(command,cwd,log,returncode,time.time()-start,usage.ru_utime+usage.ru_stime,usage.ru_maxrss)
+        if log:
+            logfile.write('# status: {0} wall: {1:.1f}s cpu: {2:.1f}s\n'.format(result.returncode,result.wall,result.cpu))
+    finally:
+        if stdout: outfile.close()
+        logfile.close()
+    Stage.addCommand(result)
+    if check and result.returncode:
+        raise CommandError(result)
+    return result
+
+def getOutputSize(paths):
+    '''Total size in bytes of the output files (and directories)'''
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                size += sum([os.path.getsize(os.path.join(root,f)) for f in files if os.path.isfile(os.path.join(root,f))])
+    return size
+
+class Stage(object):
+    '''
+    Instrument a stage of the limit pipeline for an (analysis, mode, mass, prod) point.
+    Records the wall time, the cpu time and peak RSS (kB) of the commands run
+    during the stage, and the size of the stage outputs, as a JSON line in the trace file.
+    '''
+    traceFile = ''
+    active = []
+    lock = threading.Lock()
+
+    def __init__(self,name,analysis,mode,mass,prod='',outputs=[]):
+        self.name = name
+        self.analysis = analysis
+        self.mode = mode
+        self.mass = mass
+        self.prod = prod
+        self.outputs = list(outputs)
+        self.cpu = 0.
+        self.maxrss = 0
+        self.commands = 0
+
+    @classmethod
+    def addCommand(cls,result):
+        with cls.lock:
+            for stage in cls.active:
+                stage.cpu += result.cpu
+                stage.maxrss = max(stage.maxrss,result.maxrss)
+                stage.commands += 1
+
+    def __enter__(self):
+        self.start = time.time()
+        with Stage.lock:
+            Stage.active.append(self)
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        wall = time.time()-self.start
+        with Stage.lock:
+            Stage.active.remove(self)
+        if Stage.traceFile:
+            record = {
+                'analysis': self.analysis,
+                'mode': self.mode,
+                'mass': self.mass,
+                'prod': self.prod,
+                'stage': self.name,
+                'start': self.start,
+                'wall': wall,
+                'cpu': self.cpu,
+                'maxrss': self.maxrss,
+                'commands': self.commands,
+                'output_bytes': getOutputSize(self.outputs),
+                'status': 'error' if exc_type else 'ok',
+                'pid': os.getpid(),
+            }
+            # a single short append is atomic, so the pool workers can share the trace
+            with open(Stage.traceFile,'a') as f:
+                f.write(json.dumps(record,sort_keys=True)+'\n')
+        return False
+
+def readTrace(traceFile):
+    records = []
+    if not os.path.isfile(traceFile): return records
+    with open(traceFile,'r') as f:
+        for line in f:
+            try:
+                records += [json.loads(line)]
+            except ValueError:
+                continue
+    return records
+
+def summarizeTrace(traceFile,n=10):
+    '''Log the total time per stage and the slowest stages of a run'''
+    records = readTrace(traceFile)
+    if not records: return
+    totals = {}
+    for r in records:
+        t = totals.setdefault(r['stage'],{'count':0,'wall':0.,'cpu':0.,'maxrss':0})
+        t['count'] += 1
+        t['wall'] += r['wall']
+        t['cpu'] += r['cpu']
+        t['maxrss'] = max(t['maxrss'],r['maxrss'])
+    logging.info('Stage summary (trace: {0})'.format(traceFile))
+    logging.info('    {0:12} {1:>6} {2:>12} {3:>12} {4:>12}'.format('stage','count','wall [s]','cpu [s]','maxrss [MB]'))
+    for name, t in sorted(totals.iteritems(), key=lambda x: -x[1]['wall']):
+        logging.info('    {0:12} {1:>6} {2:>12.1f} {3:>12.1f} {4:>12.1f}'.format(name,t['count'],t['wall'],t['cpu'],t['maxrss']/1024.))
+    logging.info('Slowest stages')
+    for r in sorted(records, key=lambda x: -x['wall'])[:n]:
+        logging.info('    {0:12} {1}:{2}:{3}{4} wall {5:.1f}s cpu {6:.1f}s maxrss {7:.1f}MB output {8:.1f}MB'.format(r['stage'],r['analysis'],r['mode'],r['mass'],r['prod'],r['wall'],r['cpu'],r['maxrss']/1024.,r['output_bytes']/1024.**2))
+
+_combineVersion = None
+def getCombineVersion():
+    '''Get the version of combine in this release (cached per process)'''
+    global _combineVersion
+    if _combineVersion is None:
+        combineDir = os.path.join(os.environ['CMSSW_BASE'],'src','HiggsAnalysis','CombinedLimit')
+        try:
+            with open(os.devnull,'w') as devnull:
+                version = subprocess.Popen(['git','describe','--tags','--always','--dirty'],cwd=combineDir,stdout=subprocess.PIPE,stderr=devnull).communicate()[0].strip()
+        except OSError:
+            version = ''
+        _combineVersion = '{0}:{1}'.format(os.environ.get('CMSSW_VERSION',''),version)
+    return _combineVersion
+
+def hashFile(fname,h=None):
+    '''Update a sha1 hash with the contents of a file'''
+    if h is None: h = hashlib.sha1()
+    with open(fname,'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            h.update(chunk)
+    return h
+
+def getShapeFiles(datacard):
+    '''Get the shape files referenced by a text datacard'''
+    ddir = os.path.dirname(datacard)
+    shapeFiles = []
+    with open(datacard,'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields)>3 and fields[0]=='shapes':
+                shapeFile = os.path.join(ddir,fields[3])
+                if shapeFile not in shapeFiles and os.path.isfile(shapeFile): shapeFiles += [shapeFile]
+    return shapeFiles
+
+def getCacheKey(datacard,mass,options):
+    '''
+    Content address for a combine result: hash of the datacard (and any shape files),
+    the mass, the combine version, and the combine options.
+    '''
+    h = hashFile(datacard)
+    for shapeFile in getShapeFiles(datacard):
+        hashFile(shapeFile,h)
+    h.update('mass:{0}\n'.format(mass))
+    h.update('version:{0}\n'.format(getCombineVersion()))
+    h.update('options:{0}\n'.format(' '.join(options)))
+    return h.hexdigest()
+
+def readCache(cache,key):
+    '''Read cached limits, returns None if not cached'''
+    fileName = os.path.join(cache,'{0}.txt'.format(key))
+    if not os.path.isfile(fileName): return None
+    try:
+        with open(fileName,'r') as f:
+            quartiles = [float(x) for x in f.readline().split()]
+    except (IOError, ValueError):
+        return None
+    # mark as recently used for eviction
+    try:
+        os.utime(fileName,None)
+    except OSError:
+        pass
+    return quartiles
+
+def writeCache(cache,key,quartiles,maxEntries=10000):
+    '''Store limits in the cache atomically, evicting least recently used entries'''
+    python_mkdir(cache)
+    fileName = os.path.join(cache,'{0}.txt'.format(key))
+    tmpName = '{0}.{1}.tmp'.format(fileName,os.getpid())
+    with open(tmpName,'w') as f:
+        f.write(' '.join([str(x) for x in quartiles]))
+    os.rename(tmpName,fileName)
+    evictCache(cache,maxEntries)
+
+def readResultKey(fileName):
+    '''The cache key a limits file was computed for, empty if unknown'''
+    keyName = '{0}.key'.format(fileName)
+    if not os.path.isfile(keyName): return ''
+    with open(keyName,'r') as f:
+        return f.read().strip()
+
+def writeLimitsFile(fileName,quartiles,key):
+    '''Write a limits file together with the cache key of its inputs'''
+    with open(fileName,'w') as f:
+        f.write(' '.join([str(x) for x in quartiles]))
+    with open('{0}.key'.format(fileName),'w') as f:
+        f.write(key)
+
+def evictCache(cache,maxEntries):
+    '''Remove the least recently used entries beyond maxEntries'''
+    entries = []
+    for fileName in glob.glob(os.path.join(cache,'*.txt')):
+        try:
+            entries += [(os.path.getmtime(fileName),fileName)]
+        except OSError:
+            pass
+    if len(entries)<=maxEntries: return
+    for mtime,fileName in sorted(entries)[:len(entries)-maxEntries]:
+        try:
+            os.remove(fileName)
+        except OSError:
+            pass
+
+class TaskDir(object):
+    '''
+    Isolated scratch directory for the combine calls of a single task.
+
+    Only the outputs that are promoted are moved (atomically) into the
+    shared working directory, everything else is removed on exit. The
+    directory is kept on failure for debugging. Scratch directories are
+    created under scratchTop if set (e.g. a local tmpfs), otherwise in
+    the tasks directory of the shared working directory.
+    '''
+    scratchTop = ''
+
+    def __init__(self,analysis,mode,mass,prod,stage,workfull):
+        self.tag = '{0}{1}.{2}.{3}.mH{4}'.format(analysis,prod,mode,stage,mass)
+        self.workfull = workfull
+        self.path = None
 
-def runCommand(command):
-    return subprocess.Popen(command,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT).communicate()[0]
+    def __enter__(self):
+        top = TaskDir.scratchTop if TaskDir.scratchTop else os.path.join(self.workfull,'tasks')
+        python_mkdir(top)
+        self.path = tempfile.mkdtemp(prefix='{0}.'.format(self.tag),dir=top)
+        return self
 
-def getLimits(analysis,mode,mass,outDir,prod='',doImpacts=False,retrieve=False,submit=False,dryrun=False,jobName='',skipAsymptotic=False,toys=1000,iterations=2,numPoints=100,pointsPerJob=5,gridTopDir='',rMin=0,rMax=0):
+    def promote(self,name,dest=None):
+        '''Atomically move a file from the scratch directory to dest (default: same name in workfull)'''
+        src = os.path.join(self.path,name)
+        dest = dest if dest else os.path.join(self.workfull,name)
+        python_mkdir(os.path.dirname(dest))
+        try:
+            os.rename(src,dest)
+        except OSError as e:
+            if e.errno!=errno.EXDEV: raise
+            # across filesystems, copy next to the destination first
+            tmpName = '{0}.{1}.tmp'.format(dest,os.getpid())
+            shutil.copyfile(src,tmpName)
+            os.rename(tmpName,dest)
+            os.remove(src)
+        return dest
+
+    def __exit__(self,type,value,tb):
+        if type is None:
+            shutil.rmtree(self.path,ignore_errors=True)
+        else:
+            logging.warning('Keeping task directory {0}'.format(self.path))
+        return False
+
+def workspaceUpToDate(dfull,wfull):
+    '''The workspace exists and is newer than the datacard and its shape files'''
+    if not os.path.isfile(wfull): return False
+    if not os.path.isfile(dfull): return True
+    inputTime = max([os.path.getmtime(f) for f in [dfull]+getShapeFiles(dfull)])
+    return os.path.getmtime(wfull)>=inputTime
+
+def buildWorkspace(analysis,mode,mass,dfull,wfull,log=None):
     '''
-    Submit a job using farmoutAnalysisJobs --fwklite
+    Precompile the text datacard into a binary workspace, unless the workspace
+    is already newer than the datacard and its shape files.
+    Returns the path to pass to combine (the datacard if the build failed).
     '''
+    if not os.path.isfile(dfull): return dfull
+    if workspaceUpToDate(dfull,wfull): return wfull
+    logging.info('{0}:{1}:{2}: text2workspace'.format(analysis,mode,mass))
+    # build next to the final file and rename so concurrent readers never see a partial workspace
+    wtmp = '{0}.{1}.tmp.root'.format(wfull[:-len('.root')],os.getpid())
+    command = ['text2workspace.py',dfull,'-m',mass,'-o',wtmp]
+    logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,' '.join(command)))
+    try:
+        runCommand(command,log=log)
+    except CommandError as e:
+        logging.warning('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,e))
+    if not os.path.isfile(wtmp):
+        logging.warning('{0}:{1}:{2}: text2workspace failed, using text datacard'.format(analysis,mode,mass))
+        return dfull
+    os.rename(wtmp,wfull)
+    return wfull
+
+# quantileExpected of the combine outputs in the order of the limits files, -1 is the observed
+quantilesExpected = [0.025, 0.160, 0.500, 0.840, 0.975, -1.]
+
+def readLimitTree(fname):
+    '''
+    Read the limit and quantileExpected branches of a combine output in a
+    single bulk read, returned as numpy arrays (empty if there is no tree).
+    The file is closed before returning.
+    '''
+    limits = np.zeros(0)
+    quantiles = np.zeros(0)
+    if not os.path.isfile(fname): return limits, quantiles
+    ROOT = getROOT()
+    file = ROOT.TFile.Open(fname,"READ")
+    try:
+        tree = file.Get("limit") if file and not file.IsZombie() else None
+        if tree and tree.GetEntries()>0:
+            tree.SetEstimate(tree.GetEntries()+1)
+            n = tree.Draw('limit:quantileExpected','','goff')
+            if n>0:
+                v1 = tree.GetV1()
+                v2 = tree.GetV2()
+                v1.SetSize(n)
+                v2.SetSize(n)
+                limits = np.frombuffer(v1,dtype=np.float64,count=n).copy()
+                quantiles = np.frombuffer(v2,dtype=np.float64,count=n).copy()
+    finally:
+        if file: file.Close()
+    return limits, quantiles
+
+def readQuantiles(fname):
+    '''The limit for each quantileExpected (rounded) of a combine output, the last entry wins'''
+    limits, quantiles = readLimitTree(fname)
+    return dict(zip([round(q,3) for q in quantiles],limits.tolist()))
+
+def getQuartiles(cls):
+    '''
+    The limits in the order of the limits files from the output of readQuantiles,
+    0. for the missing quantiles so the others keep their position.
+    '''
+    return [cls.get(q,0.) for q in quantilesExpected]
+
+def hasAllQuantiles(cls):
+    return all([q in cls for q in quantilesExpected])
+
+def readGridPoint(fname):
+    '''Read the CLs for each quantile from an AsymptoticLimits --singlePoint output'''
+    return readQuantiles(fname)
+
+def getGridBrackets(points,cl=0.05):
+    '''Find the intervals in r where the CLs of any quantile crosses cl'''
+    brackets = set()
+    rvals = sorted(points)
+    quantiles = set([q for r in rvals for q in points[r]])
+    for q in quantiles:
+        rq = [r for r in rvals if q in points[r]]
+        for r1, r2 in zip(rq[:-1],rq[1:]):
+            if (points[r1][q]-cl)*(points[r2][q]-cl)<=0:
+                brackets.add((r1,r2))
+    return sorted(brackets)
+
+def geometricPoints(rmin,rmax,npoints):
+    '''Geometric spacing between rmin and rmax (inclusive)'''
+    if npoints<2: return [rmin]
+    ratio = (rmax/rmin)**(1./(npoints-1))
+    return [rmin*ratio**i for i in range(npoints)]
+
+def gridSearch(analysis,mode,mass,cfull,workfull,quartiles,jobs=4,accuracy=0.01,numPoints=20,maxRounds=5,refinePoints=4,logdir=None):
+    '''
+    Adaptive AsymptoticLimits grid scan, run on a pool of local workers.
+    A coarse geometric scan is refined near the CLs=0.05 crossing of each quantile
+    until the crossings are bracketed to the relative accuracy.
+    Returns the name of the merged grid file in workfull.
+    '''
+    positive = [q for q in quartiles if q>0]
+    rmin = min(positive)/20 if positive else 1e-3
+    rmax = max(positive)*20 if positive else 1e3
+
+    def runPoint(r):
+        command = ['combine','-M','AsymptoticLimits',cfull,'-m',mass,'--singlePoint',r,'-n','grid{0}'.format(r)]
+        logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,' '.join(command)))
+        log = os.path.join(logdir,'grid{0}.mH{1}.log'.format(r,mass)) if logdir else None
+        try:
+            runCommand(command,cwd=workfull,log=log)
+        except CommandError as e:
+            # a failed point is just missing from the scan
+            logging.warning('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,e))
+        return r
+
+    points = {}
+    rvals = ['{0:.6g}'.format(r) for r in geometricPoints(rmin,rmax,numPoints)]
+    pool = ThreadPool(max(1,jobs))
+    try:
+        for n in range(maxRounds+1):
+            rvals = [r for r in sorted(set(rvals)) if r not in points]
+            if not rvals: break
+            logging.debug('{0}:{1}:{2}: Grid round {3}: {4} points'.format(analysis,mode,mass,n,len(rvals)))
+            pool.map(runPoint,rvals)
+            # ROOT is read back in the main thread
+            for r in rvals:
+                points[r] = readGridPoint(os.path.join(workfull,'higgsCombinegrid{0}.AsymptoticLimits.mH{1}.root'.format(r,mass)))
+            # refine each crossing that is not yet within the accuracy
+            byVal = dict([(float(r),points[r]) for r in points if points[r]])
+            rvals = []
+            for r1, r2 in getGridBrackets(byVal):
+                if (r2-r1)/r2 < accuracy: continue
+                rvals += ['{0:.6g}'.format(r) for r in geometricPoints(r1,r2,refinePoints+2)[1:-1]]
+    finally:
+        pool.close()
+        pool.join()
+    if not getGridBrackets(dict([(float(r),points[r]) for r in points if points[r]])):
+        logging.warning('{0}:{1}:{2}: Grid search did not bracket CLs=0.05'.format(analysis,mode,mass))
+
+    haddfile = 'limitsgrid.mH{0}.root'.format(mass)
+    sourcefiles = ['higgsCombinegrid{0}.AsymptoticLimits.mH{1}.root'.format(r,mass) for r in sorted(points)]
+    sourcefiles = [f for f in sourcefiles if os.path.isfile(os.path.join(workfull,f))]
+    command = ['hadd','-f',haddfile]+sourcefiles
+    logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,' '.join(command)))
+    runCommand(command,cwd=workfull,log=os.path.join(logdir,'haddgrid.mH{0}.log'.format(mass)) if logdir else None)
+    for f in sourcefiles:
+        os.remove(os.path.join(workfull,f))
+    return haddfile
+
+def getPaths(analysis,mode,mass,prod=''):
+    '''Paths used by the stages of an (analysis, mode, mass, prod) point'''
     srcdir = os.path.join(os.environ['CMSSW_BASE'],'src')
-    datacard = 'datacards/{0}/{1}/{2}{3}.txt'.format(analysis,mode,mass,prod)
-    workspace = 'datacards/{0}/{1}/{2}{3}.root'.format(analysis,mode,mass,prod)
-    impacts = 'impacts/{0}/{1}/{2}{3}.json'.format(analysis,mode,mass,prod)
-    outimpacts = 'impacts/{0}/{1}/{2}{3}'.format(analysis,mode,mass,prod)
+    paths = {}
+    paths['srcdir'] = srcdir
+    paths['datacard'] = 'datacards/{0}/{1}/{2}{3}.txt'.format(analysis,mode,mass,prod)
+    paths['workspace'] = 'datacards/{0}/{1}/{2}{3}.root'.format(analysis,mode,mass,prod)
+    paths['impacts'] = 'impacts/{0}/{1}/{2}{3}.json'.format(analysis,mode,mass,prod)
+    paths['outimpacts'] = 'impacts/{0}/{1}/{2}{3}'.format(analysis,mode,mass,prod)
+    # get datacard path relative to $CMSSW_BASE
+    paths['dfull'] = os.path.abspath(os.path.join(srcdir,paths['datacard']))
+    paths['wfull'] = os.path.abspath(os.path.join(srcdir,paths['workspace']))
+    paths['ifull'] = os.path.abspath(os.path.join(srcdir,paths['impacts']))
+    dsplit = paths['dfull'].split('/')
+    srcpos = dsplit.index('src')
+    paths['drel'] = '/'.join(dsplit[srcpos:])
+    paths['dreldir'] = '/'.join(dsplit[srcpos:-1])
+    paths['workfull'] = os.path.join(srcdir,'working/{0}{2}/{1}'.format(analysis,mode,prod))
+    paths['logdir'] = os.path.join(paths['workfull'],'logs')
+    paths['asymptotic'] = '{4}/{0}/{1}/{2}/{3}/limits{5}.txt'.format('asymptotic',analysis,mode,mass,srcdir,prod)
+    paths['fullCLs'] = '{4}/{0}/{1}/{2}/{3}/limits{5}.txt'.format('fullCLs',analysis,mode,mass,srcdir,prod)
+    return paths
+
+def getSampleDir(analysis,mode,mass,prod,jobName):
+    return '/{0}/{1}/{2}/{3}/{4}/{5}{6}'.format(scratchDir,pwd.getpwuid(os.getuid())[0], jobName, analysis, mode, mass, prod)
+
+def getCombineInput(paths):
+    '''The precompiled workspace if it is up to date, otherwise the text datacard'''
+    return paths['wfull'] if workspaceUpToDate(paths['dfull'],paths['wfull']) else paths['dfull']
+
+def storeLimits(analysis,mode,mass,prod,method,limits,store):
+    '''Record the limits of a point in the limit store (if any), missing (0.) quantiles are stored as NULL'''
+    if not store: return
+    try:
+        limitStore.recordLimits(analysis,mode,mass,prod,method,[x if x else None for x in limits],filename=store)
+    except limitStore.StoreError as e:
+        logging.warning('{0}:{1}:{2}: Failed to update limit store {3}: {4}'.format(analysis,mode,mass,store,e))
+
+def readLimits(fileName):
+    with open(fileName,'r') as f:
+        return [float(x) for x in f.readlines()[0].split()]
+
+# inputs of the datacards built from the Hpp3l and Hpp4l datacards (relative to $CMSSW_BASE/src),
+# a single input is copied, several are combined with combineCards.py
+cardInputs = {
+    'HppAP'   : ['datacards/Hpp3l/{mode}/{mass}AP.txt'],
+    'Hpp3lR'  : ['datacards/Hpp3l/{mode}/{mass}PPR.txt'],
+    'Hpp4lR'  : ['datacards/Hpp4l/{mode}/{mass}R.txt'],
+    'HppPP'   : ['datacards/Hpp3l/{mode}/{mass}PP.txt', 'datacards/Hpp4l/{mode}/{mass}.txt'],
+    'HppPPR'  : ['datacards/Hpp3l/{mode}/{mass}PPR.txt','datacards/Hpp4l/{mode}/{mass}R.txt'],
+    'HppComb' : ['datacards/Hpp3l/{mode}/{mass}.txt',   'datacards/Hpp4l/{mode}/{mass}.txt'],
+}
+
+def getCardInputs(analysis,mode,mass):
+    return [x.format(mode=mode,mass=mass) for x in cardInputs.get(analysis,[])]
+
+def getCardHashes(srcdir,inputs):
+    return dict([(x,hashFile(os.path.join(srcdir,x)).hexdigest()) for x in inputs])
+
+def combineDatacards(analysis,mode,mass,prod=''):
+    '''
+    Create the datacard for the analysis from the Hpp3l and Hpp4l datacards.
+    The hashes of the input cards are recorded next to the output, and the
+    card is only rebuilt (atomically) when an input changed, so unchanged
+    cards keep their mtime.
+    '''
+    paths = getPaths(analysis,mode,mass,prod)
+    srcdir = paths['srcdir']
+    datacard = os.path.join(srcdir,paths['datacard'])
+    inputs = getCardInputs(analysis,mode,mass)
 
     # mkdirs
     python_mkdir('{2}/datacards/{0}/{1}'.format(analysis,mode,srcdir))
     python_mkdir('{2}/impacts/{0}/{1}'.format(analysis,mode,srcdir))
 
+    if not inputs: return datacard
+
+    manifestName = '{0}.inputs.json'.format(datacard)
+    hashes = getCardHashes(srcdir,inputs)
+    if os.path.isfile(datacard) and readManifest(manifestName)==hashes:
+        logging.debug('{0}:{1}:{2}: Datacard up to date'.format(analysis,mode,mass))
+        return datacard
+
     # combine cards
-    if analysis=='HppAP':
-        # just cp
-        runCommand('pushd {0}; cp datacards/Hpp3l/{1}/{2}AP.txt {3}'.format(srcdir,mode,mass,datacard))
-    if analysis=='Hpp3lR':
-        # just cp
-        runCommand('pushd {0}; cp datacards/Hpp3l/{1}/{2}PPR.txt {3}'.format(srcdir,mode,mass,datacard))
-    if analysis=='Hpp4lR':
-        # just cp
-        runCommand('pushd {0}; cp datacards/Hpp4l/{1}/{2}R.txt {3}'.format(srcdir,mode,mass,datacard))
-    if analysis=='HppPP':
-        # combine 3l PP and 4l PP
-        runCommand('pushd {0}; combineCards.py datacards/Hpp3l/{1}/{2}PP.txt datacards/Hpp4l/{1}/{2}.txt > {3}'.format(srcdir,mode,mass,datacard))
-    if analysis=='HppPPR':
-        # combine 3l PPR and 4l PPR
-        runCommand('pushd {0}; combineCards.py datacards/Hpp3l/{1}/{2}PPR.txt datacards/Hpp4l/{1}/{2}R.txt > {3}'.format(srcdir,mode,mass,datacard))
-    if analysis=='HppComb':
-        # combein 3l AP, 3l PP, and 4l PP
-        runCommand('pushd {0}; combineCards.py datacards/Hpp3l/{1}/{2}.txt datacards/Hpp4l/{1}/{2}.txt > {3}'.format(srcdir,mode,mass,datacard))
+    cardlog = os.path.join(paths['logdir'],'cards.mH{0}.log'.format(mass))
+    with Stage('cards',analysis,mode,mass,prod,outputs=[datacard]):
+        tmpName = '{0}.{1}.tmp'.format(datacard,os.getpid())
+        if len(inputs)==1:
+            # just cp
+            shutil.copyfile(os.path.join(srcdir,inputs[0]),tmpName)
+        else:
+            runCommand(['combineCards.py']+inputs,cwd=srcdir,log=cardlog,stdout=tmpName)
+        os.rename(tmpName,datacard)
+        writeManifest(manifestName,hashes)
+    return datacard
 
-    # get datacard path relative to $CMSSW_BASE
-    dfull = os.path.abspath(os.path.join(os.environ['CMSSW_BASE'],'src',datacard))
-    ddir = os.path.dirname(dfull)
-    dname = os.path.basename(dfull)
-    cmssw_base = os.environ['CMSSW_BASE']
-    dsplit = dfull.split('/')
-    srcpos = dsplit.index('src')
-    drel = '/'.join(dsplit[srcpos:])
-    dreldir = '/'.join(dsplit[srcpos:-1])
+def precompileWorkspace(analysis,mode,mass,prod=''):
+    '''Precompile the workspace once, and use it for all combine calls'''
+    paths = getPaths(analysis,mode,mass,prod)
+    with Stage('workspace',analysis,mode,mass,prod,outputs=[paths['wfull']]):
+        return buildWorkspace(analysis,mode,mass,paths['dfull'],paths['wfull'],log=os.path.join(paths['logdir'],'text2workspace.mH{0}.log'.format(mass)))
 
-    # first, get the approximate bounds from asymptotic
-    work = 'working/{0}{2}/{1}'.format(analysis,mode,prod)
-    workfull = os.path.join(srcdir,work)
+def getAsymptotic(analysis,mode,mass,prod='',skipAsymptotic=False,useCache=True,cacheSize=10000,gridJobs=4,gridAccuracy=0.01,gridPoints=20,store=None):
+    '''Get the approximate bounds from asymptotic, also recorded in the limit store if given'''
+    paths = getPaths(analysis,mode,mass,prod)
+    srcdir = paths['srcdir']
+    dfull = paths['dfull']
+    cfull = getCombineInput(paths)
+    workfull = paths['workfull']
+    logdir = paths['logdir']
     python_mkdir(workfull)
-    combineCommand = 'combine -M AsymptoticLimits {0} -m {1} --saveWorkspace'.format(dfull,mass)
-    #command = 'pushd {0}; nice {1};'.format(workfull,combineCommand) 
-    command = 'pushd {0}; {1};'.format(workfull,combineCommand) 
+    combineOptions = ['-M','AsymptoticLimits','--saveWorkspace']
+    command = ['combine']+combineOptions+[cfull,'-m',mass]
 
-
-    name = 'asymptotic'
-    fileDir = '{4}/{0}/{1}/{2}/{3}'.format(name,analysis,mode,mass,srcdir)
-    python_mkdir(fileDir)
-    fileName = '{0}/limits{1}.txt'.format(fileDir,prod)
-    if skipAsymptotic and os.path.isfile(fileName):
-        with open(fileName,'r') as f:
-            quartiles = [float(x) for x in f.readlines()[0].split()]
+    fileName = paths['asymptotic']
+    python_mkdir(os.path.dirname(fileName))
+    cache = os.path.join(srcdir,cacheDir)
+    cacheKey = getCacheKey(dfull,mass,combineOptions+['grid:{0}:{1}'.format(gridPoints,gridAccuracy)]) if os.path.isfile(dfull) else ''
+    useCache = useCache and bool(cacheKey)
+    cached = readCache(cache,cacheKey) if useCache else None
+    # only reuse the limits file if it was computed from the current inputs
+    fresh = os.path.isfile(fileName) and readResultKey(fileName)==cacheKey
+    if skipAsymptotic and os.path.isfile(fileName) and not fresh:
+        logging.warning('{0}:{1}:{2}: Limits file is stale, recomputing'.format(analysis,mode,mass))
+    if skipAsymptotic and fresh:
+        quartiles = readLimits(fileName)
+    elif cached is not None:
+        quartiles = cached
+        outline = ' '.join([str(x) for x in quartiles])
+        logging.info('{0}:{1}:{2}: Limits (cached): {3}'.format(analysis,mode,mass,outline))
+        writeLimitsFile(fileName,quartiles,cacheKey)
     else:
-        logging.info('{0}:{1}:{2}: Finding Asymptotic limit: {3}'.format(analysis,mode,mass,datacard))
-        logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,combineCommand))
-        out = runCommand(command)
-
-        fname = os.path.join(workfull, "higgsCombineTest.AsymptoticLimits.mH{0}.root".format(mass))
-        file = ROOT.TFile(fname,"READ")
-        tree = file.Get("limit")
-        if not tree: 
-            logging.warning('{0}:{1}:{2}: Asymptotic presearch failed'.format(analysis,mode,mass))
-            quartiles = [0., 0., 0., 0., 0., 0.]
-        else:
-            quartiles = []
-            for i, row in enumerate(tree):
-                quartiles += [row.limit]
-            outline = ' '.join([str(x) for x in quartiles])
-            logging.info('{0}:{1}:{2}: Limits: {3}'.format(analysis,mode,mass,outline))
-
-        if len(quartiles)<6:
-            logging.warning('{0}:{1}:{2}: Attempting grid search'.format(analysis,mode,mass))
-
-            imin = min(quartiles)/20
-            imax = max(quartiles)*20
-            npoints = 100
-            deltai = (imax-imin)/(npoints)
-            i = imin
-            while i<=imax:
-                combineCommand = 'combine -M AsymptoticLimits {0} -m {1} --singlePoint {2} -n grid{2}'.format(dfull,mass,i)
-                #command = 'pushd {0}; nice {1};'.format(workfull,combineCommand)
-                command = 'pushd {0}; {1};'.format(workfull,combineCommand)
-                logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,combineCommand))
-                out = runCommand(command)
-
-                i += deltai
-
-            haddfile = 'limitsgrid.mH{0}.root'.format(mass)
-            sourcefiles = 'higgsCombinegrid*.AsymptoticLimits.mH{0}.root'.format(mass)
-            command = 'pushd {0}; hadd -f {1} {2};'.format(workfull,haddfile,sourcefiles)
-            logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,command))
-            out = runCommand(command)
-            command = 'pushd {0}; rm {1};'.format(workfull,sourcefiles)
-            logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,command))
-            out = runCommand(command)
-
-            combineCommand = 'combine -M AsymptoticLimits {0} -m {1} --getLimitFromGrid {2} -n Grid'.format(dfull,mass,haddfile)
-            command = 'pushd {0}; {1};'.format(workfull,combineCommand)
-            logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,combineCommand))
-            out = runCommand(command)
-
-            fname = os.path.join(workfull, "higgsCombineGrid.AsymptoticLimits.mH{0}.root".format(mass))
-            file = ROOT.TFile(fname,"READ")
-            tree = file.Get("limit")
-            if not tree: 
-                logging.warning('{0}:{1}:{2}: Asymptotic grid presearch failed'.format(analysis,mode,mass))
+        with Stage('asymptotic',analysis,mode,mass,prod,outputs=[fileName]), TaskDir(analysis,mode,mass,prod,'asymptotic',workfull) as task:
+            logging.info('{0}:{1}:{2}: Finding Asymptotic limit: {3}'.format(analysis,mode,mass,paths['datacard']))
+            logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,' '.join(command)))
+            fname = os.path.join(task.path, "higgsCombineTest.AsymptoticLimits.mH{0}.root".format(mass))
+            try:
+                runCommand(command,cwd=task.path,log=os.path.join(logdir,'asymptotic.mH{0}.log'.format(mass)))
+            except CommandError as e:
+                logging.warning('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,e))
+
+            cls = readQuantiles(fname)
+            if not cls:
+                logging.warning('{0}:{1}:{2}: Asymptotic presearch failed'.format(analysis,mode,mass))
                 quartiles = [0., 0., 0., 0., 0., 0.]
             else:
-                quartiles = []
-                for i, row in enumerate(tree):
-                    quartiles += [row.limit]
+                quartiles = getQuartiles(cls)
                 outline = ' '.join([str(x) for x in quartiles])
-                logging.info('{0}:{1}:{2}: Limits (from grid): {3}'.format(analysis,mode,mass,outline))
+                logging.info('{0}:{1}:{2}: Limits: {3}'.format(analysis,mode,mass,outline))
+            if os.path.isfile(fname): task.promote(os.path.basename(fname))
 
-        with open(fileName,'w') as f:
-            outline = ' '.join([str(x) for x in quartiles])
-            f.write(outline)
+            if not hasAllQuantiles(cls):
+                with Stage('grid',analysis,mode,mass,prod) as stage:
+                    logging.warning('{0}:{1}:{2}: Attempting grid search'.format(analysis,mode,mass))
 
-    if submit:
-        sample_dir = '/{0}/{1}/{2}/{3}/{4}/{5}{6}'.format(scratchDir,pwd.getpwuid(os.getuid())[0], jobName, analysis, mode, mass, prod)
+                    haddfile = gridSearch(analysis,mode,mass,cfull,task.path,quartiles,jobs=gridJobs,accuracy=gridAccuracy,numPoints=gridPoints,logdir=logdir)
+
+                    command = ['combine','-M','AsymptoticLimits',cfull,'-m',mass,'--getLimitFromGrid',haddfile,'-n','Grid']
+                    logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,' '.join(command)))
+                    fname = os.path.join(task.path, "higgsCombineGrid.AsymptoticLimits.mH{0}.root".format(mass))
+                    try:
+                        runCommand(command,cwd=task.path,log=os.path.join(logdir,'asymptoticgrid.mH{0}.log'.format(mass)))
+                    except CommandError as e:
+                        logging.warning('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,e))
+
+                    cls = readQuantiles(fname)
+                    if not cls:
+                        logging.warning('{0}:{1}:{2}: Asymptotic grid presearch failed'.format(analysis,mode,mass))
+                        quartiles = [0., 0., 0., 0., 0., 0.]
+                    else:
+                        quartiles = getQuartiles(cls)
+                        outline = ' '.join([str(x) for x in quartiles])
+                        logging.info('{0}:{1}:{2}: Limits (from grid): {3}'.format(analysis,mode,mass,outline))
+                    if os.path.isfile(fname): task.promote(os.path.basename(fname))
+                    if os.path.isfile(os.path.join(task.path,haddfile)):
+                        stage.outputs += [task.promote(haddfile)]
+
+            # a failed search leaves no limits file so the point is retried on the next run
+            if not (len(quartiles)==6 and any(quartiles)):
+                if os.path.isfile(fileName): os.remove(fileName)
+                raise StageError('{0}:{1}:{2}: Asymptotic limits failed'.format(analysis,mode,mass))
+
+            writeLimitsFile(fileName,quartiles,cacheKey)
+
+            # only cache successful searches
+            if useCache:
+                writeCache(cache,cacheKey,quartiles,cacheSize)
+
+    storeLimits(analysis,mode,mass,prod,'asymptotic',quartiles,store)
+    return quartiles
+
+def getAdaptivePoints(centers,numPoints,rmin,rmax,window=0.2,coarseFraction=0.2):
+    '''
+    Place a coarse set of points uniformly over [rmin,rmax] and concentrate the
+    rest in a window of relative half width `window` around each expected crossing.
+    '''
+    centers = sorted(set([c for c in centers if c>0]))
+    nCoarse = int(round(numPoints*coarseFraction)) if centers else numPoints
+    points = [rmin + i*(rmax-rmin)/max(nCoarse-1,1) for i in range(nCoarse)]
+    if centers:
+        nFine = numPoints-nCoarse
+        for j,c in enumerate(centers):
+            n = nFine//len(centers) + (1 if j<nFine%len(centers) else 0)
+            lo = c*(1-window)
+            hi = c*(1+window)
+            points += [lo + i*(hi-lo)/max(n-1,1) for i in range(n)]
+    return sorted(set([float('{0:.6g}'.format(r)) for r in points if r>0]))
+
+def getToyAllocation(rvalues,centers,toys,window=0.2,minFraction=0.2):
+    '''
+    Number of toys for each point: the full number of toys at an expected
+    crossing, falling off with a width of half the window to minFraction of
+    them away from all crossings.
+    '''
+    centers = [c for c in centers if c>0]
+    allocation = []
+    for r in rvalues:
+        if centers:
+            d = min([abs(r-c)/(0.5*window*c) for c in centers])
+            w = math.exp(-0.5*d*d)
+        else:
+            w = 1.
+        allocation += [max(1,int(round(toys*(minFraction+(1-minFraction)*w))))]
+    return allocation
+
+def getSweepPoints(quartiles,toys,numPoints,pointsPerJob,rMin=0,rMax=0,adaptive=False,window=0.2):
+    '''The r values and the toys per iteration at each of them submitted for a point (first round)'''
+    rmin = rMin if rMin else 0.8*min([q for q in quartiles if q>0])
+    rmax = rMax if rMax else 1.2*max(quartiles)
+    if adaptive:
+        rvalues = getAdaptivePoints(quartiles,numPoints,rmin,rmax,window)
+        return rvalues, getToyAllocation(rvalues,quartiles,toys,window)
+    rvalues = [r*(rmax-rmin)/numPoints + rmin + i*(rmax-rmin)/pointsPerJob for r in range(int(numPoints/pointsPerJob)) for i in range(pointsPerJob)]
+    return rvalues, [toys]*len(rvalues)
+
+def getExpectedCLs(r,limit):
+    '''Rough CLs at r given the r of the CLs=0.05 crossing, from the asymptotic shape 2(1-Phi(1.96 r/limit))'''
+    if limit<=0: return 1.
+    return math.erfc(1.96*r/limit/math.sqrt(2.))
+
+def getConvergedToys(cls,toys,iterations,clsAcc=0.,clsSigma=3.,target=0.05):
+    '''
+    Toys thrown at a point with a CLs of cls. With clsAcc, the job stops after
+    the first round of toys where the CLs error (taken as binomial) is below
+    clsAcc or CLs is more than clsSigma errors from the target, and after
+    iterations rounds at the latest, so never more than the fixed budget.
+    '''
+    if clsAcc<=0: return toys*iterations
+    for rounds in range(1,iterations+1):
+        err = math.sqrt(cls*(1-cls)/(rounds*toys))
+        if err<clsAcc or abs(cls-target)>clsSigma*err: break
+    return rounds*toys
+
+def estimateToys(quartiles,toys=1000,iterations=2,numPoints=100,pointsPerJob=5,rMin=0,rMax=0,adaptive=False,window=0.2,clsAcc=0.,clsSigma=3.):
+    '''Number of points and total number of toys a submission of a point is expected to throw'''
+    rvalues, allocation = getSweepPoints(quartiles,toys,numPoints,pointsPerJob,rMin,rMax,adaptive,window)
+    # CLs at each point is evaluated on data, so converge around the observed limit
+    positive = sorted([q for q in quartiles if q>0])
+    limit = quartiles[5] if len(quartiles)>5 and quartiles[5]>0 else positive[len(positive)//2]
+    return len(rvalues), sum([getConvergedToys(getExpectedCLs(r,limit),t,iterations,clsAcc,clsSigma) for r,t in zip(rvalues,allocation)])
+
+def estimateSweep(args,analyses,branchingPoints,masses):
+    '''Log the toys and core-hours a submission of all the points would take, from their asymptotic limits'''
+    options = {
+        'toys'         : args.T,
+        'iterations'   : args.i,
+        'numPoints'    : args.numPoints,
+        'pointsPerJob' : args.pointsPerJob,
+        'rMin'         : args.rMin,
+        'rMax'         : args.rMax,
+        'adaptive'     : args.adaptive,
+        'window'       : args.window,
+    }
+    hours = lambda n: n*args.secondsPerToy/3600.
+    logging.info('Estimate at {0} s per toy{1}'.format(args.secondsPerToy,', clsAcc {0}'.format(args.clsAcc) if args.clsAcc>0 else ''))
+    logging.info('    {0:24} {1:>6} {2:>12} {3:>12} {4:>12}'.format('point','points','toys','core-hours','fixed [h]'))
+    total = {'toys':0, 'fixed':0}
+    for an in analyses:
+        for bp in branchingPoints:
+            for m in masses:
+                for post in getProds(an):
+                    paths = getPaths(an,bp,m,post)
+                    if not os.path.isfile(paths['asymptotic']):
+                        logging.warning('{0}:{1}:{2}: No asymptotic limits, run without --estimate first'.format(an,bp,m))
+                        continue
+                    quartiles = readLimits(paths['asymptotic'])
+                    if not any(quartiles):
+                        logging.warning('{0}:{1}:{2}: Asymptotic limits failed'.format(an,bp,m))
+                        continue
+                    nPoints, toys = estimateToys(quartiles,clsAcc=args.clsAcc,clsSigma=args.clsSigma,**options)
+                    fixed = estimateToys(quartiles,**options)[1]
+                    total['toys'] += toys
+                    total['fixed'] += fixed
+                    logging.info('    {0:24} {1:>6} {2:>12} {3:>12.1f} {4:>12.1f}'.format(':'.join([an,bp,str(m)+post]),nPoints,toys,hours(toys),hours(fixed)))
+    logging.info('    {0:24} {1:>6} {2:>12} {3:>12.1f} {4:>12.1f}'.format('total','',total['toys'],hours(total['toys']),hours(total['fixed'])))
+    return total
+
+class CondorBackend(object):
+    '''Run the work units as a condor DAG with farmoutAnalysisJobs'''
+    def __init__(self,dryrun=False):
+        self.dryrun = dryrun
+
+    def getSampleDir(self,analysis,mode,mass,prod,jobName):
+        return getSampleDir(analysis,mode,mass,prod,jobName)
+
+    def getGridTopDir(self,jobName):
+        return '/hdfs/store/user/{0}/{1}'.format(pwd.getpwuid(os.getuid())[0], jobName)
+
+    def getOutputDir(self,analysis,mode,mass,prod,jobName):
+        return 'srm://cmssrm.hep.wisc.edu:8443/srm/v2/server?SFN={0}/{1}/{2}/{3}{4}'.format(self.getGridTopDir(jobName), analysis, mode, mass, prod)
+
+    def submit(self,name,sample_dir,submit_dir,dag_dir,input_name,bash_name,output_dir,usercode):
+        # create farmout command
+        farmoutCommand = ['farmoutAnalysisJobs','--infer-cmssw-path','--fwklite','--input-file-list={0}'.format(input_name),'--assume-input-files-exist']
+        farmoutCommand += ['--submit-dir={0}'.format(submit_dir),'--output-dag-file={0}'.format(dag_dir),'--output-dir={0}'.format(output_dir)]
+        farmoutCommand += ['--extra-usercode-files={0}'.format(usercode),name,bash_name]
+
+        if not self.dryrun:
+            logging.info('Submitting {0}'.format(name))
+            runCommand(farmoutCommand,log='{0}/farmout.log'.format(sample_dir))
+        else:
+            print ' '.join([pipes.quote(x) for x in farmoutCommand])
+        return True
+
+class LocalBackend(object):
+    '''
+    Run the work units on this machine, at most jobs at a time.
+
+    Each unit runs the job script with its line of the input list, a seed
+    derived from the job name and unit number, and writes its merged output
+    into the grid directory used by the retrieve stage. Finished units are
+    not rerun, and the submit directory is only created once all units
+    succeeded.
+    '''
+    def __init__(self,jobs=4,topDir='',dryrun=False):
+        self.jobs = jobs
+        self.topDir = topDir if topDir else os.path.join(os.environ['CMSSW_BASE'],'src','local')
+        self.dryrun = dryrun
+
+    def getSampleDir(self,analysis,mode,mass,prod,jobName):
+        return '{0}/submit/{1}/{2}/{3}/{4}{5}'.format(self.topDir,jobName,analysis,mode,mass,prod)
+
+    def getGridTopDir(self,jobName):
+        return '{0}/toys/{1}'.format(self.topDir,jobName)
+
+    def getOutputDir(self,analysis,mode,mass,prod,jobName):
+        return '{0}/{1}/{2}/{3}{4}'.format(self.getGridTopDir(jobName),analysis,mode,mass,prod)
+
+    def getSeed(self,name,output_dir,unit):
+        return int(hashlib.sha1('{0}:{1}:{2}'.format(name,output_dir,unit)).hexdigest()[:7],16)
+
+    def runUnit(self,name,sample_dir,bash_name,output_dir,unit,line):
+        output = os.path.join(output_dir,'{0}-{1}.root'.format(name,unit))
+        if os.path.isfile(output): return True
+        workdir = os.path.join(sample_dir,'local','unit{0}'.format(unit))
+        python_mkdir(workdir)
+        inputFile = os.path.join(workdir,'input.txt')
+        with open(inputFile,'w') as f:
+            f.write('{0}\n'.format(line))
+        tmpOutput = os.path.join(workdir,'output.root')
+        env = dict(os.environ)
+        env.update({'INPUT': inputFile, 'OUTPUT': tmpOutput, 'SEED': str(self.getSeed(name,output_dir,unit))})
+        try:
+            runCommand(['bash',bash_name],cwd=workdir,log=os.path.join(workdir,'job.log'),env=env)
+        except CommandError as e:
+            logging.warning('{0}: unit {1}: {2}'.format(name,unit,e))
+            return False
+        shutil.move(tmpOutput,output)
+        return True
+
+    def submit(self,name,sample_dir,submit_dir,dag_dir,input_name,bash_name,output_dir,usercode):
+        with open(input_name,'r') as f:
+            units = [line.strip() for line in f if line.strip()]
+        if self.dryrun:
+            for unit, line in enumerate(units):
+                print 'INPUT={0} SEED={1} bash {2}'.format(pipes.quote(line),self.getSeed(name,output_dir,unit),bash_name)
+            return True
+        python_mkdir(output_dir)
+        logging.info('Running {0}: {1} units on {2} cores'.format(name,len(units),self.jobs))
+        # the units are separate processes, threads only wait on them
+        pool = ThreadPool(self.jobs)
+        try:
+            results = pool.map(lambda x: self.runUnit(name,sample_dir,bash_name,output_dir,*x),list(enumerate(units)))
+        finally:
+            pool.close()
+            pool.join()
+        nfailed = len([r for r in results if not r])
+        if nfailed:
+            # fail the node so the partial grid is not retrieved
+            raise StageError('{0}: {1} of {2} units failed, rerun to retry them'.format(name,nfailed,len(units)))
+        python_mkdir(submit_dir)
+        return True
+
+backends = {
+    'condor' : CondorBackend,
+    'local'  : LocalBackend,
+}
+
+def getBackend(backend='condor',dryrun=False,localJobs=4,localDir=''):
+    if backend=='local':
+        return LocalBackend(jobs=localJobs,topDir=localDir,dryrun=dryrun)
+    return backends[backend](dryrun=dryrun)
+
+# run in the job with the toys of a point so far: exits 0 once CLs is known to the
+# accuracy, or is more than the given number of standard deviations away from 0.05
+clsCheckScript = '''import sys
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+acc, nsigma = float(sys.argv[1]), float(sys.argv[2])
+result = None
+for fname in sys.argv[3:]:
+    tfile = ROOT.TFile.Open(fname)
+    toys = tfile.Get('toys') if tfile and not tfile.IsZombie() else None
+    if toys:
+        for key in toys.GetListOfKeys():
+            if not key.GetClassName().endswith('HypoTestResult'): continue
+            res = key.ReadObj()
+            if result is None:
+                result = res.Clone()
+            else:
+                result.Append(res)
+    if tfile: tfile.Close()
+if result is None: sys.exit(1)
+cls, err = result.CLs(), result.CLsError()
+print('CLs = {0} +/- {1}'.format(cls,err))
+sys.exit(0 if err<acc or abs(cls-0.05)>nsigma*err else 1)
+'''
+
+def getConvergenceScript(crel,mass,iterations,rmax,rmin,clsAcc,clsSigma):
+    '''
+    Bash function "runPoint R TOYS" for the job script: rounds of TOYS toys at
+    r=R, each with its own seed, until CLs is known to clsAcc or is more than
+    clsSigma standard deviations from 0.05, at most iterations rounds.
+    '''
+    script = 'cat > clsConverged.py << "EOF"\n' + clsCheckScript + 'EOF\n'
+    script += 'NPOINT=0\n'
+    script += 'runPoint() {\n'
+    script += '    NPOINT=$((NPOINT+1))\n'
+    script += '    mkdir -p point$NPOINT\n'
+    script += '    pushd point$NPOINT > /dev/null\n'
+    script += '    for ROUND in $(seq 1 {0}); do\n'.format(iterations)
+    script += '        combine $CMSSW_BASE/{0} -M HybridNew --freq -s $SEED --singlePoint $1 --saveToys --fullBToys --clsAcc 0 --saveHybridResult -m {1} -n Tag -T $2 -i 1 --rMax {2} --rMin {3} -v -2\n'.format(crel,mass,rmax,rmin)
+    script += '        if [ $SEED -ge 0 ]; then SEED=$((SEED+1)); fi\n'
+    script += '        if python ../clsConverged.py {0:g} {1:g} higgsCombineTag.HybridNew.mH{2}.*.root; then break; fi\n'.format(clsAcc,clsSigma,mass)
+    script += '    done\n'
+    script += '    mv higgsCombineTag.HybridNew.mH{0}.*.root ..\n'.format(mass)
+    script += '    popd > /dev/null\n'
+    script += '    rm -rf point$NPOINT\n'
+    script += '}\n'
+    return script
+
+def submitFullCLs(analysis,mode,mass,prod='',dryrun=False,jobName='',toys=1000,iterations=2,numPoints=100,pointsPerJob=5,rMin=0,rMax=0,adaptive=False,refine=False,window=0.2,backend='condor',localJobs=4,localDir='',clsAcc=0.,clsSigma=3.):
+    '''
+    Submit a job using farmoutAnalysisJobs --fwklite, or run it locally with the local backend
+    Returns False if the submission directory already exists, raises
+    StageError if units of the local backend failed.
+
+    With adaptive, the points and toys are concentrated around the expected
+    crossings from the asymptotic bands. With refine, a second round is
+    submitted around the limits retrieved from the first round, into the
+    same output directory so that retrieval merges both rounds.
+
+    With clsAcc, each point throws rounds of toys until its CLs is known to
+    clsAcc, or is more than clsSigma standard deviations away from 0.05, with
+    at most iterations rounds (see getConvergedToys and --estimate).
+    '''
+    paths = getPaths(analysis,mode,mass,prod)
+    quartiles = readLimits(paths['asymptotic'])
+    crel = '/'.join([paths['dreldir'],os.path.basename(getCombineInput(paths))])
+    with Stage('refine' if refine else 'submit',analysis,mode,mass,prod) as stage:
+        runner = getBackend(backend,dryrun=dryrun,localJobs=localJobs,localDir=localDir)
+        sample_dir = runner.getSampleDir(analysis,mode,mass,prod,jobName)
+        farmoutName = jobName
+        if refine:
+            sample_dir += '_refine'
+            farmoutName += '_refine'
 
         # create submit dir
         submit_dir = '{0}/submit'.format(sample_dir)
         if os.path.exists(submit_dir):
-            logging.warning('Submission directory exists for {0}.'.format(jobName))
-            return
+            logging.warning('Submission directory exists for {0}.'.format(farmoutName))
+            return False
         # setup the job parameters
-        rmin = rMin if rMin else 0.8*min(quartiles)
+        rmin = rMin if rMin else 0.8*min([q for q in quartiles if q>0])
         rmax = rMax if rMax else 1.2*max(quartiles)
         num_points = numPoints
         points_per_job = pointsPerJob
 
         # create dag dir
         dag_dir = '{0}/dags/dag'.format(sample_dir)
-        os.system('mkdir -p {0}'.format(os.path.dirname(dag_dir)))
-        os.system('mkdir -p {0}'.format(dag_dir+'inputs'))
+        python_mkdir(os.path.dirname(dag_dir))
+        python_mkdir(dag_dir+'inputs')
+        stage.outputs += [dag_dir+'inputs']
 
         # output dir
-        output_dir = 'srm://cmssrm.hep.wisc.edu:8443/srm/v2/server?SFN=/hdfs/store/user/{0}/{1}/{2}/{3}/{4}{5}'.format(pwd.getpwuid(os.getuid())[0], jobName, analysis, mode, mass, prod)
+        output_dir = runner.getOutputDir(analysis,mode,mass,prod,jobName)
 
-        # create file list
-        rlist = [r*(rmax-rmin)/num_points + rmin for r in range(int(num_points/points_per_job))]
         input_name = '{0}/rvalues.txt'.format(dag_dir+'inputs')
-        with open(input_name,'w') as file:
-            for r in rlist:
-                file.write('{0}\n'.format(r))
-
-        # create bash script
         bash_name = '{0}/{1}.sh'.format(dag_dir+'inputs', jobName)
         bashScript = '#!/bin/bash\n'
         #bashScript += 'printenv\n'
-        bashScript += 'read -r RVAL < $INPUT\n'
-        for i in range(points_per_job):
-            dr = i*(rmax-rmin)/points_per_job
-            bashScript += 'combine $CMSSW_BASE/{0} -M HybridNew --freq -s -1 --singlePoint $(bc -l <<< "$RVAL+{1}") --saveToys --fullBToys --clsAcc 0 --saveHybridResult -m {2} -n Tag -T {3} -i {4} --rMax {5} --rMin {6} -v -2\n'.format(drel,dr,mass,toys,iterations,rmax,rmin)
-            #bashScript += 'rm -f tmp/rstats*\n' # try cleaning up tmp files to avoid too uch disk space
+        # random seeds unless the backend sets one per unit, one seed per point so the outputs do not clash
+        bashScript += 'SEED=${SEED:--1}\n'
+        if adaptive or refine:
+            centers = quartiles
+            coarseFraction = 0.2
+            if refine:
+                # narrow down around the limits from the first round
+                if os.path.isfile(paths['fullCLs']):
+                    centers = readLimits(paths['fullCLs'])
+                else:
+                    logging.warning('{0}:{1}:{2}: No fullCLs limits to refine, using asymptotic'.format(analysis,mode,mass))
+                window = window/3.
+                coarseFraction = 0.
+            rvalues = getAdaptivePoints(centers,num_points,rmin,rmax,window,coarseFraction)
+            allocation = getToyAllocation(rvalues,centers,toys,window)
+            logging.info('{0}:{1}:{2}: Adaptive submission: {3} points, {4} toys (uniform: {5} points, {6} toys)'.format(analysis,mode,mass,len(rvalues),sum(allocation),num_points,num_points*toys))
+            rmin = min(rmin,min(rvalues))
+            rmax = max(rmax,max(rvalues))
+
+            # each job gets a list of "r:toys" points
+            points = ['{0:.6g}:{1}'.format(r,t) for r,t in zip(rvalues,allocation)]
+            with open(input_name,'w') as file:
+                for i in range(0,len(points),points_per_job):
+                    file.write('{0}\n'.format(','.join(points[i:i+points_per_job])))
+
+            if clsAcc>0: bashScript += getConvergenceScript(crel,mass,iterations,rmax,rmin,clsAcc,clsSigma)
+            bashScript += 'for POINT in $(tr "," " " < $INPUT); do\n'
+            bashScript += '    RVAL=${POINT%:*}\n'
+            bashScript += '    TOYS=${POINT#*:}\n'
+            if clsAcc>0:
+                bashScript += '    runPoint $RVAL $TOYS\n'
+            else:
+                bashScript += '    combine $CMSSW_BASE/{0} -M HybridNew --freq -s $SEED --singlePoint $RVAL --saveToys --fullBToys --clsAcc 0 --saveHybridResult -m {1} -n Tag -T $TOYS -i {2} --rMax {3} --rMin {4} -v -2\n'.format(crel,mass,iterations,rmax,rmin)
+                bashScript += '    if [ $SEED -ge 0 ]; then SEED=$((SEED+1)); fi\n'
+            bashScript += 'done\n'
+        else:
+            # create file list
+            rlist = [r*(rmax-rmin)/num_points + rmin for r in range(int(num_points/points_per_job))]
+            with open(input_name,'w') as file:
+                for r in rlist:
+                    file.write('{0}\n'.format(r))
+
+            # create bash script
+            if clsAcc>0: bashScript += getConvergenceScript(crel,mass,iterations,rmax,rmin,clsAcc,clsSigma)
+            bashScript += 'read -r RVAL < $INPUT\n'
+            for i in range(points_per_job):
+                dr = i*(rmax-rmin)/points_per_job
+                if clsAcc>0:
+                    bashScript += 'runPoint $(bc -l <<< "$RVAL+{0}") {1}\n'.format(dr,toys)
+                    continue
+                bashScript += 'combine $CMSSW_BASE/{0} -M HybridNew --freq -s $SEED --singlePoint $(bc -l <<< "$RVAL+{1}") --saveToys --fullBToys --clsAcc 0 --saveHybridResult -m {2} -n Tag -T {3} -i {4} --rMax {5} --rMin {6} -v -2\n'.format(crel,dr,mass,toys,iterations,rmax,rmin)
+                bashScript += 'if [ $SEED -ge 0 ]; then SEED=$((SEED+1)); fi\n'
+                #bashScript += 'rm -f tmp/rstats*\n' # try cleaning up tmp files to avoid too uch disk space
         bashScript += 'hadd $OUTPUT higgsCombineTag.HybridNew.mH{0}.*.root\n'.format(mass)
         bashScript += 'rm higgsCombineTag.HybridNew.mH{0}.*.root\n'.format(mass)
         with open(bash_name,'w') as file:
             file.write(bashScript)
-        os.system('chmod +x {0}'.format(bash_name))
+        os.chmod(bash_name,0755)
 
-        # create farmout command
-        farmoutString = 'farmoutAnalysisJobs --infer-cmssw-path --fwklite --input-file-list={0} --assume-input-files-exist'.format(input_name)
-        farmoutString += ' --submit-dir={0} --output-dag-file={1} --output-dir={2}'.format(submit_dir, dag_dir, output_dir)
-        farmoutString += ' --extra-usercode-files="{0}" {1} {2}'.format(dreldir, jobName, bash_name)
+        return runner.submit(farmoutName,sample_dir,submit_dir,dag_dir,input_name,bash_name,output_dir,paths['dreldir'])
 
-        if not dryrun:
-            logging.info('Submitting {0}/{1}/{2}/{3}{4}'.format(jobName,analysis,mode,mass,prod))
-            os.system(farmoutString)
-        else:
-            print farmoutString
+def runImpacts(analysis,mode,mass,prod='',jobs=4,jobMode='interactive'):
+    '''
+    Now do the higgs combineharvester stuff.
+    The per-nuisance fits are run jobs at a time with combineTool.py --parallel,
+    or submitted to condor with jobMode='condor'. In that case the fits are
+    run from a persistent directory and the impacts are collected by the
+    first rerun after all fits finished.
+    '''
+    paths = getPaths(analysis,mode,mass,prod)
+    srcdir = paths['srcdir']
+    wfull = paths['wfull']
+    ifull = paths['ifull']
+    workfull = paths['workfull']
+    python_mkdir(workfull)
+    implog = os.path.join(paths['logdir'],'impacts.mH{0}.log'.format(mass))
+    impacts = ['combineTool.py','-M','Impacts','-d',wfull,'-m',mass]
 
+    if jobMode=='condor':
+        fitdir = os.path.join(workfull,'impacts_mH{0}'.format(mass))
+        python_mkdir(fitdir)
+        marker = os.path.join(fitdir,'submitted')
+        with Stage('impacts',analysis,mode,mass,prod) as stage:
+            if not os.path.exists(marker):
+                logging.info('{0}:{1}:{2}: Impacts: initial fit'.format(analysis,mode,mass))
+                runCommand(impacts+['--doInitialFit','--robustFit','1'],cwd=fitdir,log=implog)
+                logging.info('{0}:{1}:{2}: Impacts: submitting nuissance fits'.format(analysis,mode,mass))
+                taskName = 'impacts_{0}{1}_{2}_{3}'.format(analysis,prod,mode,mass)
+                runCommand(impacts+['--robustFit','1','--doFits','--job-mode','condor','--task-name',taskName],cwd=fitdir,log=implog)
+                open(marker,'w').close()
+                logging.info('{0}:{1}:{2}: Impacts: rerun once the fits are done to collect them'.format(analysis,mode,mass))
+                return
+            logging.info('{0}:{1}:{2}: Impacts: saving/plotting'.format(analysis,mode,mass))
+            try:
+                runCommand(impacts+['-o',ifull],cwd=fitdir,log=implog)
+            except CommandError as e:
+                logging.warning('{0}:{1}:{2}: Impacts: fits not finished yet ({3})'.format(analysis,mode,mass,e))
+                return
+            stage.outputs += [ifull]
+            runCommand(['plotImpacts.py','-i',ifull,'-o',paths['outimpacts']],cwd=srcdir,log=implog)
+        return
 
-    # now do the higgs combineharvester stuff
-    if doImpacts:
-        wfull = os.path.abspath(os.path.join(os.environ['CMSSW_BASE'],'src',workspace))
-        ifull = os.path.abspath(os.path.join(os.environ['CMSSW_BASE'],'src',impacts))
-        logging.info('{0}:{1}:{2}: text2workspace'.format(analysis,mode,mass))
-        command = 'text2workspace.py {0} -m {1}'.format(dfull,mass)
-        runCommand(command)
+    with Stage('impacts',analysis,mode,mass,prod,outputs=[ifull]), TaskDir(analysis,mode,mass,prod,'impacts',workfull) as task:
         logging.info('{0}:{1}:{2}: Impacts: initial fit'.format(analysis,mode,mass))
-        #command = 'pushd {0}; nice combineTool.py -M Impacts -d {1} -m {2} --doInitialFit --robustFit 1'.format(workfull,wfull,mass)
-        command = 'pushd {0}; combineTool.py -M Impacts -d {1} -m {2} --doInitialFit --robustFit 1'.format(workfull,wfull,mass)
-        runCommand(command)
-        logging.info('{0}:{1}:{2}: Impacts: nuissance fits'.format(analysis,mode,mass))
-        #command = 'pushd {0}; nice combineTool.py -M Impacts -d {1} -m {2} --robustFit 1 --doFits'.format(workfull,wfull,mass)
-        command = 'pushd {0}; combineTool.py -M Impacts -d {1} -m {2} --robustFit 1 --doFits'.format(workfull,wfull,mass)
-        runCommand(command)
+        runCommand(impacts+['--doInitialFit','--robustFit','1'],cwd=task.path,log=implog)
+        logging.info('{0}:{1}:{2}: Impacts: nuissance fits ({3} in parallel)'.format(analysis,mode,mass,jobs))
+        runCommand(impacts+['--robustFit','1','--doFits','--parallel',jobs],cwd=task.path,log=implog)
         logging.info('{0}:{1}:{2}: Impacts: saving/plotting'.format(analysis,mode,mass))
-        command = 'pushd {0}; combineTool.py -M Impacts -d {1} -m {2} -o {3}'.format(workfull,wfull,mass,ifull)
-        runCommand(command)
-        command = 'pushd {0}; plotImpacts.py -i {1} -o {2}'.format(srcdir,ifull,outimpacts)
-        runCommand(command)
-
-    # now get the fullCLs
-    if retrieve:
-        args = [
-            ['Expected 0.025', '--expectedFromGrid 0.025', 'higgsCombineTest.HybridNew.mH{0}.quant0.025.root'],
-            ['Expected 0.160', '--expectedFromGrid 0.160', 'higgsCombineTest.HybridNew.mH{0}.quant0.160.root'],
-            ['Expected 0.500', '--expectedFromGrid 0.500', 'higgsCombineTest.HybridNew.mH{0}.quant0.500.root'],
-            ['Expected 0.840', '--expectedFromGrid 0.840', 'higgsCombineTest.HybridNew.mH{0}.quant0.840.root'],
-            ['Expected 0.975', '--expectedFromGrid 0.975', 'higgsCombineTest.HybridNew.mH{0}.quant0.975.root'],
-            ['Observed',       '',                         'higgsCombineTest.HybridNew.mH{0}.root'],
-        ]
-        
-        # merge the output
-        if not gridTopDir:
-            logging.error('You must specify a top level directory for grid points')
-            return
-        gridfile = 'grid_{0}.root'.format(mass)
+        runCommand(impacts+['-o','impacts.json'],cwd=task.path,log=implog)
+        task.promote('impacts.json',ifull)
+        runCommand(['plotImpacts.py','-i',ifull,'-o',paths['outimpacts']],cwd=srcdir,log=implog)
+
+def readManifest(fileName):
+    '''Read a json manifest (merged job outputs, datacard input hashes), empty if missing or unreadable'''
+    if not os.path.isfile(fileName): return {}
+    try:
+        with open(fileName,'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def writeManifest(fileName,manifest):
+    tmpName = '{0}.{1}.tmp'.format(fileName,os.getpid())
+    with open(tmpName,'w') as f:
+        json.dump(manifest,f,indent=0,sort_keys=True)
+    os.rename(tmpName,fileName)
+
+def mergeGrid(analysis,mode,mass,sourceDir,workfull,gridfile,jobs=4,batchSize=50,log=None):
+    '''
+    Incrementally merge the job outputs in sourceDir into gridfile.
+    A manifest next to the grid file records the outputs already merged, so
+    only new outputs are added, hadded in parallel batches and then merged
+    with the existing grid. Everything is remerged if a merged output changed.
+    Returns the number of newly merged outputs.
+    '''
+    gridfull = os.path.join(workfull,gridfile)
+    manifestName = '{0}.manifest.json'.format(gridfull)
+    manifest = readManifest(manifestName) if os.path.isfile(gridfull) else {}
+    current = {}
+    for fname in sorted(glob.glob('{0}/*.root'.format(sourceDir))):
+        try:
+            current[fname] = [os.path.getsize(fname),os.path.getmtime(fname)]
+        except OSError:
+            pass
+    changed = [f for f in manifest if f in current and current[f]!=manifest[f]]
+    if changed or any([f not in current for f in manifest]):
+        logging.warning('{0}:{1}:{2}: Merged outputs changed, remerging all'.format(analysis,mode,mass))
+        manifest = {}
+    newFiles = sorted([f for f in current if f not in manifest])
+    if not newFiles:
+        logging.info('{0}:{1}:{2}: Grid up to date ({3} outputs)'.format(analysis,mode,mass,len(manifest)))
+        return 0
+    logging.info('{0}:{1}:{2}: Merging {3} new outputs ({4} already merged)'.format(analysis,mode,mass,len(newFiles),len(manifest)))
+
+    # hadd the new outputs in parallel batches
+    partdir = tempfile.mkdtemp(prefix='merge_mH{0}.'.format(mass),dir=workfull)
+    batches = [newFiles[i:i+batchSize] for i in range(0,len(newFiles),batchSize)]
+    def mergeBatch(arg):
+        i, batch = arg
+        if len(batch)==1: return batch[0]
+        part = os.path.join(partdir,'part{0}.root'.format(i))
+        runCommand(['hadd','-f',part]+batch,cwd=partdir,log=log)
+        return part
+    pool = ThreadPool(max(1,min(jobs,len(batches))))
+    try:
+        parts = pool.map(mergeBatch,list(enumerate(batches)))
+    finally:
+        pool.close()
+        pool.join()
+
+    # fold the batches into the existing grid
+    inputs = ([gridfull] if manifest else [])+parts
+    tmpGrid = os.path.join(partdir,gridfile)
+    if len(inputs)==1:
+        shutil.copyfile(inputs[0],tmpGrid)
+    else:
+        runCommand(['hadd','-f',tmpGrid]+inputs,cwd=partdir,log=log)
+    os.rename(tmpGrid,gridfull)
+    shutil.rmtree(partdir)
+    for f in newFiles: manifest[f] = current[f]
+    writeManifest(manifestName,manifest)
+    return len(newFiles)
+
+def retrieveFullCLs(analysis,mode,mass,prod='',gridTopDir='',mergeJobs=4,mergeBatch=50,store=None):
+    '''Merge the grid points and get the fullCLs, also recorded in the limit store if given'''
+    paths = getPaths(analysis,mode,mass,prod)
+    cfull = getCombineInput(paths)
+    workfull = paths['workfull']
+    logdir = paths['logdir']
+    python_mkdir(workfull)
+    quartiles = readLimits(paths['asymptotic'])
+    args = [
+        ['Expected 0.025', '--expectedFromGrid 0.025', 'higgsCombineTest.HybridNew.mH{0}.quant0.025.root', 'quant0.025'],
+        ['Expected 0.160', '--expectedFromGrid 0.160', 'higgsCombineTest.HybridNew.mH{0}.quant0.160.root', 'quant0.160'],
+        ['Expected 0.500', '--expectedFromGrid 0.500', 'higgsCombineTest.HybridNew.mH{0}.quant0.500.root', 'quant0.500'],
+        ['Expected 0.840', '--expectedFromGrid 0.840', 'higgsCombineTest.HybridNew.mH{0}.quant0.840.root', 'quant0.840'],
+        ['Expected 0.975', '--expectedFromGrid 0.975', 'higgsCombineTest.HybridNew.mH{0}.quant0.975.root', 'quant0.975'],
+        ['Observed',       '',                         'higgsCombineTest.HybridNew.mH{0}.root',            'observed'],
+    ]
+
+    # merge the output
+    if not gridTopDir:
+        logging.error('You must specify a top level directory for grid points')
+        return
+    gridfile = 'grid_{0}.root'.format(mass)
+    with Stage('merge',analysis,mode,mass,prod,outputs=[os.path.join(workfull,gridfile)]):
         sourceDir = '{0}/{1}/{2}/{3}{4}'.format(gridTopDir,analysis,mode,mass,prod)
         logging.info('{0}:{1}:{2}: Merging: {3}'.format(analysis,mode,mass,sourceDir))
-        haddCommand = 'hadd -f {0} {1}/*.root'.format(gridfile,sourceDir)
-        command = 'pushd {0}; {1};'.format(workfull,haddCommand)
-        logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,haddCommand))
-        out = runCommand(command)
-        logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,out))
+        mergeGrid(analysis,mode,mass,sourceDir,workfull,gridfile,jobs=mergeJobs,batchSize=mergeBatch,log=os.path.join(logdir,'haddfullCLs.mH{0}.log'.format(mass)))
 
-        # get CL
-        fullQuartiles = []
+    with Stage('retrieve',analysis,mode,mass,prod) as stage:
+        # get CL, each quantile concurrently in its own directory so the combine outputs do not clash
         rMax = max(quartiles)
-        rMin = min(quartiles)
-        for i in range(len(args)):
-            logging.info('{0}:{1}:{2}: Calculating: {3}'.format(analysis,mode,mass,args[i][0]))
-            combineCommand = 'combine {0} -M HybridNew --freq --grid={1} -m {2} --rAbsAcc 0.001 --rRelAcc 0.001 --rMax {3} --rMin {4} {5}'.format(dfull, gridfile, mass, rMax, rMin, args[i][1])
-            command = 'pushd {0}; {1};'.format(workfull, combineCommand)
-            logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,combineCommand))
-            outfile = '{0}/{1}'.format(workfull,args[i][2].format(mass))
-            out = runCommand(command)
-            logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,out))
-
-            # read the limit
-            file = ROOT.TFile(outfile,"READ")
-            tree = file.Get("limit")
-            if not tree:
-                logging.warning('HybridNew failed')
-                val = 0.
-            else:
-                val = 0.
-                for i, row in enumerate(tree):
-                    val = row.limit
-            fullQuartiles += [val]
+        rMin = min([q for q in quartiles if q>0])
+        gridfull = os.path.join(workfull,gridfile)
+        def runQuantile(arg):
+            label, option, outname, tag = arg
+            quantdir = os.path.join(workfull,'retrieve_mH{0}'.format(mass),tag)
+            python_mkdir(quantdir)
+            outfile = os.path.join(quantdir,outname.format(mass))
+            if os.path.isfile(outfile): os.remove(outfile)
+            logging.info('{0}:{1}:{2}: Calculating: {3}'.format(analysis,mode,mass,label))
+            command = ['combine',cfull,'-M','HybridNew','--freq','--grid={0}'.format(gridfull),'-m',mass,'--rAbsAcc','0.001','--rRelAcc','0.001','--rMax',rMax,'--rMin',rMin]+option.split()
+            logging.debug('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,' '.join(command)))
+            try:
+                runCommand(command,cwd=quantdir,log=os.path.join(quantdir,'combine.log'))
+            except CommandError as e:
+                logging.warning('{0}:{1}:{2}: {3}'.format(analysis,mode,mass,e))
+            return outfile
+
+        pool = ThreadPool(len(args))
+        try:
+            outfiles = pool.map(runQuantile,args)
+        finally:
+            pool.close()
+            pool.join()
+
+        # read the limits (ROOT only in the main thread)
+        fullQuartiles = []
+        for quantile, outfile in zip(quantilesExpected,outfiles):
+            cls = readQuantiles(outfile)
+            if quantile not in cls:
+                logging.warning('{0}:{1}:{2}: HybridNew failed: {3}'.format(analysis,mode,mass,os.path.basename(outfile)))
+            fullQuartiles += [cls.get(quantile,0.)]
 
-        name = 'fullCLs'
-        fileDir = '{4}/{0}/{1}/{2}/{3}'.format(name,analysis,mode,mass,srcdir)
-        python_mkdir(fileDir)
-        fileName = '{0}/limits{1}.txt'.format(fileDir,prod)
+        fileName = paths['fullCLs']
+        python_mkdir(os.path.dirname(fileName))
+        stage.outputs += [fileName]
 
         with open(fileName,'w') as f:
             outline = ' '.join([str(x) for x in fullQuartiles])
             logging.info('{0}:{1}:{2}: Full Limits: {3}'.format(analysis,mode,mass,outline))
             f.write(outline)
 
+        storeLimits(analysis,mode,mass,prod,'fullCLs',fullQuartiles,store)
+
+# analyses whose datacards are built from the datacards of other analyses
+cardDependencies = dict([(an,sorted(set([x.split('/')[1] for x in cards]))) for an,cards in cardInputs.items()])
+
+def getProds(analysis):
+    return ['AP','PP'] if analysis=='Hpp3l' else ['']
+
+class Node(object):
+    '''A single stage of a point in the task graph'''
+    def __init__(self,name,func,args=(),kwargs={},deps=[],inputs=[],outputs=[],serial=False):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs)
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.serial = serial
+
+    def upToDate(self):
+        '''All outputs exist and are newer than the existing inputs'''
+        if not self.outputs: return False
+        if not all([os.path.exists(o) for o in self.outputs]): return False
+        inputs = [i for i in self.inputs if os.path.exists(i)]
+        if not inputs: return True
+        return min([os.path.getmtime(o) for o in self.outputs]) >= max([os.path.getmtime(i) for i in inputs])
+
+def nodeWrapper(args):
+    name, func, fargs, fkwargs = args
+    try:
+        func(*fargs,**fkwargs)
+    except Exception as e:
+        # report back instead of bringing down the pool
+        logging.error('{0}: {1}'.format(name,e))
+        return name, False
+    return name, True
+
+class TaskGraph(object):
+    '''
+    Dependency-aware scheduler for the stage nodes.
+
+    A node starts as soon as all of its dependencies have finished, so the
+    points of all analyses and branching points share a single worker pool.
+    Nodes whose outputs are up to date are skipped and nodes depending on a
+    failed node are not run.
+    '''
+    def __init__(self,force=False):
+        self.nodes = {}
+        self.order = []
+        self.force = force
+
+    def add(self,name,func,args=(),kwargs={},deps=[],inputs=[],outputs=[],serial=False):
+        '''Add a node, serial nodes run one at a time in this process instead of on the workers'''
+        self.nodes[name] = Node(name,func,args,kwargs,[d for d in deps if d],inputs,outputs,serial)
+        self.order += [name]
+        return name
+
+    def pending(self,funcs):
+        '''The nodes running one of funcs that are not up to date'''
+        return [name for name in self.order if self.nodes[name].func in funcs and (self.force or not self.nodes[name].upToDate())]
+
+    def run(self,j=1):
+        '''Run the graph on j workers, returns the names of the failed nodes'''
+        waiting = {}
+        dependents = dict([(name,[]) for name in self.order])
+        for name in self.order:
+            deps = [d for d in self.nodes[name].deps if d in self.nodes]
+            waiting[name] = set(deps)
+            for d in deps: dependents[d] += [name]
+        ready = [name for name in self.order if not waiting[name]]
+        failed = set()
+        counts = {'run': 0, 'skipped': 0, 'failed': 0}
+        finished = Queue.Queue()
+        pool = Pool(j) if j>1 else None
+        # the serial nodes share a single thread of this process, so they run next to the workers
+        serialPool = ThreadPool(1) if pool else None
+        running = 0
+
+        def release(name):
+            for d in dependents[name]:
+                waiting[d].discard(name)
+                if not waiting[d]: ready.append(d)
+
+        try:
+            while ready or running:
+                while ready and not (running and not pool):
+                    name = ready.pop(0)
+                    node = self.nodes[name]
+                    if any([d in failed for d in node.deps]):
+                        logging.warning('{0}: not run, dependency failed'.format(name))
+                        failed.add(name)
+                        counts['failed'] += 1
+                        release(name)
+                    elif not self.force and node.upToDate():
+                        logging.info('{0}: up to date'.format(name))
+                        counts['skipped'] += 1
+                        release(name)
+                    elif serialPool and node.serial:
+                        serialPool.apply_async(nodeWrapper,[(name,node.func,node.args,node.kwargs)],callback=finished.put)
+                        running += 1
+                    elif pool:
+                        pool.apply_async(nodeWrapper,[(name,node.func,node.args,node.kwargs)],callback=finished.put)
+                        running += 1
+                    else:
+                        finished.put(nodeWrapper((name,node.func,node.args,node.kwargs)))
+                        running += 1
+                if not running: continue
+                # poll with a timeout so the wait can be interrupted
+                while True:
+                    try:
+                        name, ok = finished.get(True,1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running -= 1
+                if ok:
+                    counts['run'] += 1
+                else:
+                    failed.add(name)
+                    counts['failed'] += 1
+                release(name)
+        except KeyboardInterrupt:
+            if pool: pool.terminate()
+            if serialPool: serialPool.terminate()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+            serialPool.close()
+            serialPool.join()
+        logging.info('Tasks: {0} run, {1} up to date, {2} failed'.format(counts['run'],counts['skipped'],counts['failed']))
+        return failed
+
+def buildTaskGraph(args,analyses,branchingPoints,masses):
+    '''Build the stage nodes for every (analysis, branching point, mass, prod)'''
+    graph = TaskGraph(force=args.force)
+    asymptoticOptions = {
+        'skipAsymptotic' : args.skipAsymptotic,
+        'useCache'       : not args.noCache,
+        'cacheSize'      : args.cacheSize,
+        'gridJobs'       : args.gridJobs,
+        'gridAccuracy'   : args.gridAccuracy,
+        'gridPoints'     : args.gridPoints,
+        'store'          : getStoreFile(args),
+    }
+    submitOptions = {
+        'dryrun'         : args.dryrun,
+        'jobName'        : args.jobName,
+        'toys'           : args.T,
+        'iterations'     : args.i,
+        'numPoints'      : args.numPoints,
+        'pointsPerJob'   : args.pointsPerJob,
+        'rMin'           : args.rMin,
+        'rMax'           : args.rMax,
+        'adaptive'       : args.adaptive,
+        'refine'         : args.refine,
+        'window'         : args.window,
+        'backend'        : args.backend,
+        'localJobs'      : args.localJobs,
+        'localDir'       : args.localDir,
+        'clsAcc'         : args.clsAcc,
+        'clsSigma'       : args.clsSigma,
+    }
+    runner = getBackend(args.backend,localJobs=args.localJobs,localDir=args.localDir)
+    gridTopDir = getGridTopDir(args,runner)
+    for an in analyses:
+        for bp in branchingPoints:
+            for m in masses:
+                for post in getProds(an):
+                    point = (an,bp,m,post)
+                    key = '{0}{3}:{1}:{2}'.format(*point)
+                    paths = getPaths(*point)
+                    cardDeps = ['{0}{3}:{1}:{2}:cards'.format(dep,bp,m,p) for dep in cardDependencies.get(an,[]) for p in getProds(dep)]
+                    cards = graph.add(key+':cards',combineDatacards,point,deps=cardDeps)
+                    workspace = graph.add(key+':workspace',precompileWorkspace,point,deps=[cards],inputs=[paths['dfull']],outputs=[paths['wfull']])
+                    asymptotic = graph.add(key+':asymptotic',getAsymptotic,point,kwargs=asymptoticOptions,deps=[workspace],inputs=[paths['dfull'],paths['wfull']],outputs=[paths['asymptotic']])
+                    submit = None
+                    if args.submit:
+                        submitDir = '{0}{1}/submit'.format(runner.getSampleDir(an,bp,m,post,args.jobName),'_refine' if args.refine else '')
+                        submit = graph.add(key+':submit',submitFullCLs,point,kwargs=submitOptions,deps=[asymptotic],outputs=[] if args.dryrun else [submitDir],serial=True)
+                    if args.impacts:
+                        graph.add(key+':impacts',runImpacts,point,kwargs={'jobs':args.impactsJobs,'jobMode':args.impactsJobMode},deps=[workspace],inputs=[paths['wfull']],outputs=[paths['ifull']])
+                    if args.retrieve:
+                        gridFiles = glob.glob('{0}/{1}/{2}/{3}{4}/*.root'.format(gridTopDir,an,bp,m,post)) if gridTopDir else []
+                        graph.add(key+':retrieve',retrieveFullCLs,point,kwargs={'gridTopDir':gridTopDir,'mergeJobs':args.mergeJobs,'mergeBatch':args.mergeBatch,'store':getStoreFile(args)},deps=[asymptotic,submit],inputs=[paths['asymptotic']]+gridFiles,outputs=[paths['fullCLs']])
+    return graph
+
+def getStoreFile(args):
+    if args.noLimitStore: return None
+    return args.limitStore if args.limitStore else limitStore.getDefaultStore()
+
+def getGridTopDir(args,runner):
+    '''Grid points are taken from the backend output unless given'''
+    if args.gridTopDir: return args.gridTopDir
+    if args.backend=='local' or args.orchestrate: return runner.getGridTopDir(args.jobName)
+    return ''
+
+def parseRetryBudget(budgets):
+    '''Retry budget per error code from CODE:N strings'''
+    budget = {}
+    for b in budgets:
+        code, n = b.split(':')
+        budget[int(code)] = int(n)
+    return budget
+
+def orchestrate(args,analyses,branchingPoints,masses,skip=set()):
+    '''
+    Watch the condor DAGs of the submitted points, resubmit the rescue DAGs
+    of failed nodes while the retry budget for their error codes lasts, and
+    retrieve each point as soon as its DAG is done.
+    Failures without an error code count against code 0. A point whose DAG
+    writes no (new) status file for statusTimeout seconds, after submission
+    or a resubmission, fails.
+    Returns the names of the points that failed.
+    '''
+    runner = getBackend(args.backend)
+    budget = parseRetryBudget(args.retryBudget)
+    retrieveOptions = {'gridTopDir':getGridTopDir(args,runner),'mergeJobs':args.mergeJobs,'mergeBatch':args.mergeBatch,'store':getStoreFile(args)}
+    pending = {}
+    for an in analyses:
+        for bp in branchingPoints:
+            for m in masses:
+                for post in getProds(an):
+                    key = '{0}{3}:{1}:{2}'.format(an,bp,m,post)
+                    if key+':submit' in skip: continue
+                    sample = runner.getSampleDir(an,bp,m,post,args.jobName)+('_refine' if args.refine else '')
+                    pending[key] = ((an,bp,m,post),sample)
+    retries = dict([(key,{}) for key in pending])
+    resubmitted = {}
+    retrievals = {}
+    failed = set()
+    waitingSince = dict([(key,time.time()) for key in pending])
+    # the retrievals read limit trees, load ROOT once before forking the workers
+    if pending: getROOT()
+    pool = Pool(args.j)
+    try:
+        while pending or retrievals:
+            for key, (point, sample) in sorted(pending.items()):
+                status = resubmitLimits.get_dag_status(sample)
+                if status is None or status['key']==resubmitted.get(key):
+                    if time.time()-waitingSince[key]>args.statusTimeout:
+                        logging.error('{0}: no DAG status after {1} s, giving up'.format(key,args.statusTimeout))
+                        failed.add(key)
+                        del pending[key]
+                    continue
+                waitingSince[key] = time.time()
+                # still running
+                if status['submitted'] or status['queued'] or status['done']+status['failed']<status['total']: continue
+                if status['errors'] or status['failed']:
+                    codes = sorted(set(status['nodeErrors'])) or [0]
+                    exhausted = [c for c in codes if retries[key].get(c,0)>=budget.get(c,args.maxRetries)]
+                    rescues = glob.glob('{0}/dags/*dag.rescue[0-9][0-9][0-9]'.format(sample))
+                    if exhausted or not rescues:
+                        logging.error('{0}: {1} nodes failed, not resubmitting ({2})'.format(key,status['failed'],'retry budget exhausted for error codes {0}'.format(exhausted) if exhausted else 'no rescue DAG'))
+                        failed.add(key)
+                        del pending[key]
+                        continue
+                    for c in codes: retries[key][c] = retries[key].get(c,0)+1
+                    logging.warning('{0}: resubmitting {1} failed nodes (error codes {2})'.format(key,status['failed'],codes))
+                    try:
+                        runCommand(['farmoutAnalysisJobs','--rescue-dag-file={0}'.format(max(rescues))],log=os.path.join(sample,'rescue.log'))
+                    except CommandError as e:
+                        logging.error('{0}: {1}'.format(key,e))
+                        failed.add(key)
+                        del pending[key]
+                        continue
+                    # wait for condor to rewrite the status file before looking again
+                    resubmitted[key] = status['key']
+                    waitingSince[key] = time.time()
+                    continue
+                logging.info('{0}: DAG done, retrieving'.format(key))
+                retrievals[key] = pool.apply_async(nodeWrapper,[(key+':retrieve',retrieveFullCLs,point,retrieveOptions)])
+                del pending[key]
+            for key, result in retrievals.items():
+                if not result.ready(): continue
+                name, ok = result.get()
+                if not ok: failed.add(key)
+                del retrievals[key]
+            if pending or retrievals:
+                logging.info('Waiting on {0} DAGs, {1} retrievals running'.format(len(pending),len(retrievals)))
+                time.sleep(args.pollInterval if pending else 10)
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return failed
 
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(description='Process limits')
@@ -313,12 +1566,29 @@ def parse_command_line(argv):
     parser.add_argument('-am','--allMasses',action='store_true',help='Run over all masses')
     parser.add_argument('-aa','--allAnalyses',action='store_true',help='Run over all anlayses')
     parser.add_argument('--impacts',action='store_true',help='Do impacts (slower)')
+    parser.add_argument('--impactsJobs',type=int,default=4,help='Number of concurrent nuisance fits for the impacts')
+    parser.add_argument('--impactsJobMode',type=str,default='interactive',choices=['interactive','condor'],help='Run the impacts fits locally or submit them to condor (rerun to collect)')
     # job submission
     parser.add_argument('--jobName', nargs='?',type=str,default='',help='Jobname for submission')
     parser.add_argument('-s','--submit',action='store_true',help='Submit Full CLs')
     parser.add_argument('-sa','--skipAsymptotic',action='store_true',help='Skip calculating asymptotic (read from file)')
+    parser.add_argument('--noCache',action='store_true',help='Do not use the asymptotic result cache')
+    parser.add_argument('--cacheSize',type=int,default=10000,help='Maximum number of cached asymptotic results')
+    parser.add_argument('--gridJobs',type=int,default=4,help='Number of concurrent points in the asymptotic grid search')
+    parser.add_argument('--gridAccuracy',type=float,default=0.01,help='Relative accuracy on r for the asymptotic grid search')
+    parser.add_argument('--gridPoints',type=int,default=20,help='Number of points in the coarse asymptotic grid search')
+    parser.add_argument('--backend',type=str,default='condor',choices=['condor','local'],help='Where to run the toys: condor (farmout) or this machine')
+    parser.add_argument('--localJobs',type=int,default=4,help='Number of concurrent work units for the local backend')
+    parser.add_argument('--localDir',type=str,default='',help='Top directory for the local backend (default: $CMSSW_BASE/src/local)')
+    parser.add_argument('--orchestrate',action='store_true',help='Submit, resubmit failed nodes and retrieve each point as soon as its DAG is done')
+    parser.add_argument('--maxRetries',type=int,default=3,help='Default number of rescue DAG submissions per error code')
+    parser.add_argument('--retryBudget',nargs='*',type=str,default=[],help='Rescue DAG submissions for specific error codes, as CODE:N')
+    parser.add_argument('--statusTimeout',type=int,default=3600,help='Seconds to wait for the DAG status file of a point before it fails')
+    parser.add_argument('--pollInterval',type=int,default=300,help='Seconds between DAG status polls')
     parser.add_argument('-r','--retrieve',action='store_true',help='Retrieve Full CLs')
     parser.add_argument('--gridTopDir', nargs='?',type=str,default='',help='Top level directory for grid points')
+    parser.add_argument('--mergeJobs',type=int,default=4,help='Number of concurrent hadd batches when merging grid points')
+    parser.add_argument('--mergeBatch',type=int,default=50,help='Number of grid point files per hadd batch')
     parser.add_argument('-dr','--dryrun',action='store_true',help='Dryrun for submission')
     parser.add_argument('-T',type=int,default=1000,help='Number of toys')
     parser.add_argument('-i',type=int,default=2,help='Iterations')
@@ -326,8 +1596,20 @@ def parse_command_line(argv):
     parser.add_argument('--rMax',type=float,default=0,help='Use custom max value for r')
     parser.add_argument('-n','--numPoints',type=int,default=100,help='Number of points')
     parser.add_argument('-p','--pointsPerJob',type=int,default=5,help='Iterations')
+    parser.add_argument('--adaptive',action='store_true',help='Concentrate points and toys around the expected crossings')
+    parser.add_argument('--refine',action='store_true',help='Submit a refinement round around the retrieved fullCLs limits')
+    parser.add_argument('--window',type=float,default=0.2,help='Relative half width of the adaptive window around each crossing')
+    parser.add_argument('--clsAcc',type=float,default=0.,help='Stop the rounds of -T toys at each point once CLs is known to this accuracy (at most -i rounds)')
+    parser.add_argument('--clsSigma',type=float,default=3.,help='With --clsAcc, also stop once CLs is this many errors away from 0.05')
+    parser.add_argument('--estimate',action='store_true',help='Only estimate the toys and core-hours of the submission from the asymptotic limits')
+    parser.add_argument('--secondsPerToy',type=float,default=0.5,help='CPU seconds per toy for --estimate')
+    parser.add_argument('--scratch',type=str,default='',help='Top directory for the per task scratch directories, e.g. a local tmpfs (default: working directory)')
+    parser.add_argument('--limitStore',type=str,default='',help='Limit store to update (default: $CMSSW_BASE/src/limits.db)')
+    parser.add_argument('--noLimitStore',action='store_true',help='Do not update the limit store')
     # logging
     parser.add_argument('-j',type=int,default=7,help='Number of cores')
+    parser.add_argument('-f','--force',action='store_true',help='Rerun stages even if their outputs are up to date')
+    parser.add_argument('--trace',nargs='?',type=str,default='',help='Trace file for stage timing (default: traces/limits_<time>.jsonl)')
     parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
 
     args = parser.parse_args(argv)
@@ -347,31 +1629,39 @@ def main(argv=None):
     allowedBranchingPoints = ['ee100','em100','mm100','et100','mt100','tt100','BP1','BP2','BP3','BP4'] if args.allBranchingPoints else [args.branchingPoint]
     allowedMasses = masses if args.allMasses else [args.mass]
 
-    for an in allowedAnalyses:
-        for bp in allowedBranchingPoints:
-            if len(allowedMasses)==1 or args.submit:
-                for m in allowedMasses:
-                    postfix = ['']
-                    if an=='Hpp3l': postfix = ['AP','PP']
-                    for post in postfix:
-                        getLimits(an,bp,m,args.directory,post,args.impacts,args.retrieve,args.submit,args.dryrun,args.jobName,args.skipAsymptotic,args.T,args.i,args.numPoints,args.pointsPerJob,args.gridTopDir,args.rMin,args.rMax)
-            else:
-                allArgs = []
-                for m in allowedMasses:
-                    postfix = ['']
-                    if an=='Hpp3l': postfix = ['AP','PP']
-                    for post in postfix:
-                        newArgs = [an,bp,m,args.directory,post,args.impacts,args.retrieve,args.submit,args.dryrun,args.jobName,args.skipAsymptotic,args.T,args.i,args.numPoints,args.pointsPerJob,args.gridTopDir,args.rMin,args.rMax]
-                        allArgs += [newArgs]
-                p = Pool(args.j)
-                try:
-                    p.map_async(limitsWrapper, allArgs).get(999999)
-                except KeyboardInterrupt:
-                    p.terminate()
-                    print 'limits cancelled'
-                    sys.exit(1)
-
-    return 0
+    if args.estimate:
+        estimateSweep(args,allowedAnalyses,allowedBranchingPoints,allowedMasses)
+        return 0
+
+    # set before any workers are forked so they all write to the same trace
+    srcdir = os.path.join(os.environ['CMSSW_BASE'],'src')
+    Stage.traceFile = args.trace if args.trace else os.path.join(srcdir,'traces','limits_{0}_{1}.jsonl'.format(time.strftime('%Y%m%d_%H%M%S'),os.getpid()))
+    python_mkdir(os.path.dirname(os.path.abspath(Stage.traceFile)))
+    if args.scratch: TaskDir.scratchTop = os.path.abspath(args.scratch)
+
+    # condor points are retrieved once their DAG is done, local points right after running,
+    # a dry run submits nothing so there is nothing to retrieve
+    watchDags = args.orchestrate and args.backend=='condor' and not args.dryrun
+    if args.orchestrate:
+        args.submit = True
+        args.retrieve = not watchDags and not args.dryrun
+
+    # run all stages of all points as one dependency graph, only the submissions are serial
+    graph = buildTaskGraph(args,allowedAnalyses,allowedBranchingPoints,allowedMasses)
+    # ROOT is only loaded by the stages reading limit trees, load it before the
+    # workers are forked so they inherit it rather than each importing it
+    if args.j>1 and graph.pending([getAsymptotic,retrieveFullCLs]): getROOT()
+    try:
+        failed = graph.run(args.j)
+        if watchDags:
+            failed |= orchestrate(args,allowedAnalyses,allowedBranchingPoints,allowedMasses,skip=failed)
+    except KeyboardInterrupt:
+        print 'limits cancelled'
+        sys.exit(1)
+
+    summarizeTrace(Stage.traceFile)
+
+    return 1 if failed else 0
 
 
 if __name__ == "__main__":
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 
-import ROOT
+import sys
+import argparse
+from multiprocessing import Pool
+from rootLoader import getROOT
 import math
 import json
 
 def printObjects(workspace,func):
     print func
     args = getattr(workspace,func)()
-    if isinstance(args,ROOT.RooArgSet):
+    if isinstance(args,getROOT().RooArgSet):
         args.Print()
     else:
         for arg in args:
@@ -29,6 +32,21 @@ def getArgsetMap(workspace,func):
         var = it.Next()
     return allVars
 
+def getDependencyIndex(allVars,allFuncs):
+    '''Map each variable to the names of the functions whose value depends on it'''
+    ROOT = getROOT()
+    index = dict([(v,[]) for v in allVars])
+    for f,func in allFuncs.iteritems():
+        deps = func.getVariables()
+        ROOT.SetOwnership(deps,True)
+        it = deps.createIterator()
+        var = it.Next()
+        while var:
+            name = var.GetName()
+            if name in index: index[name].append(f)
+            var = it.Next()
+    return index
+
 def getVals(allFuncs):
     expMap = {}
     expMapB = {}
@@ -41,44 +59,48 @@ def getVals(allFuncs):
             expMap[f] = v.getVal()
     return expMap, expMapB
 
-def getUncertainty(expMap,shiftMap):
-    total = 0.
-    totalShift = 0.
-    for f in expMap:
-        total += expMap[f]
-        totalShift += shiftMap[f]
+def getShiftedTotal(allFuncs,expMap,total,names):
+    '''The total expected with only the named functions re-evaluated'''
+    return total + sum([allFuncs[f].getVal()-expMap[f] for f in names if f in expMap])
+
+def getUncertainty(total,totalShift):
     unc = abs(total-totalShift)/total if total else 0.
     return unc
 
-def varyNuisances(allVars, allFuncs, *nuis):
+def varyNuisances(allVars, allFuncs, *nuis, **kwargs):
+    # with a dependency index only the functions depending on a nuisance are re-evaluated
+    index = kwargs.get('index',None)
     # get unvaried expected for each channel
     expMap, expMapB = getVals(allFuncs)
-    # vary each nuisance independently and get change in expected
-    varyMap = {'up':{}, 'down':{}}
-    varyMapB = {'up':{}, 'down':{}}
+    total = sum(expMap.values())
+    # vary each nuisance independently and get change in the total expected
+    varyTotal = {'up':{}, 'down':{}}
     for n in nuis:
         if n not in allVars:
             print 'Unrecognized nuisance {0}'.format(n)
             continue
+        if index is None:
+            shift = lambda: sum(getVals(allFuncs)[0].values())
+        else:
+            shift = lambda: getShiftedTotal(allFuncs,expMap,total,index[n])
         allVars[n].setVal(1.)
-        varyMap['up'][n], varyMapB['up'][n] = getVals(allFuncs)
+        varyTotal['up'][n] = shift()
         allVars[n].setVal(-1.)
-        varyMap['down'][n], varyMapB['down'][n] = getVals(allFuncs)
+        varyTotal['down'][n] = shift()
         allVars[n].setVal(0.)
     # sum of squares the changes
     err2 = {'up':0.,'down':0.}
     for n in nuis:
         if n not in allVars: continue
-        err2['up'] += getUncertainty(expMap,varyMap['up'][n])**2
-        err2['down'] += getUncertainty(expMap,varyMap['down'][n])**2
+        err2['up'] += getUncertainty(total,varyTotal['up'][n])**2
+        err2['down'] += getUncertainty(total,varyTotal['down'][n])**2
     return (err2['up']**0.5 + err2['down']**0.5)/2.
 
 def getCardUncertainties(analysis,mode,mass):
     filename = 'working/{0}/{1}/higgsCombineTest.Asymptotic.mH{2}.root'.format(analysis,mode,mass)
+    ROOT = getROOT(combine=True)
     tfile = ROOT.TFile(filename)
     
-    ROOT.gSystem.Load("libHiggsAnalysisCombinedLimit")
-    
     workspace = tfile.Get("w")
     
     allVars = getArgsetMap(workspace,'allVars')
@@ -92,32 +114,88 @@ def getCardUncertainties(analysis,mode,mass):
     #print 'functions'
     #printDict(allFunctions)
     
+    index = getDependencyIndex(allVars,allFunctions)
     uncertainties = {}
-    uncertainties['lumi'] =      varyNuisances(allVars,allFunctions,*[x for x in allVars if x.startswith('lumi') and not x.endswith('In')])
-    uncertainties['sigAP'] =       varyNuisances(allVars,allFunctions,*['sig_unc_AP'])
-    uncertainties['sigPP'] =       varyNuisances(allVars,allFunctions,*['sig_unc_PP'])
-    #uncertainties['charge'] =    varyNuisances(allVars,allFunctions,*[x for x in allVars if 'charge' in x and not x.endswith('In')])
-    uncertainties['elec_id'] =   varyNuisances(allVars,allFunctions,*['elec_id'])
-    uncertainties['muon_id'] =   varyNuisances(allVars,allFunctions,*['muon_id'])
-    uncertainties['tau_id'] =    varyNuisances(allVars,allFunctions,*['tau_id'])
-    uncertainties['stat'] =      varyNuisances(allVars,allFunctions,*[x for x in allVars if x.startswith('stat') and not x.endswith('In')])
-    uncertainties['alpha_unc'] = varyNuisances(allVars,allFunctions,*[x for x in allVars if x.startswith('alpha_unc') and not x.endswith('In')])
+    uncertainties['lumi'] =      varyNuisances(allVars,allFunctions,*[x for x in allVars if x.startswith('lumi') and not x.endswith('In')],index=index)
+    uncertainties['sigAP'] =       varyNuisances(allVars,allFunctions,*['sig_unc_AP'],index=index)
+    uncertainties['sigPP'] =       varyNuisances(allVars,allFunctions,*['sig_unc_PP'],index=index)
+    #uncertainties['charge'] =    varyNuisances(allVars,allFunctions,*[x for x in allVars if 'charge' in x and not x.endswith('In')],index=index)
+    uncertainties['elec_id'] =   varyNuisances(allVars,allFunctions,*['elec_id'],index=index)
+    uncertainties['muon_id'] =   varyNuisances(allVars,allFunctions,*['muon_id'],index=index)
+    uncertainties['tau_id'] =    varyNuisances(allVars,allFunctions,*['tau_id'],index=index)
+    uncertainties['stat'] =      varyNuisances(allVars,allFunctions,*[x for x in allVars if x.startswith('stat') and not x.endswith('In')],index=index)
+    uncertainties['alpha_unc'] = varyNuisances(allVars,allFunctions,*[x for x in allVars if x.startswith('alpha_unc') and not x.endswith('In')],index=index)
     return uncertainties
 
 analyses = ['Hpp3lAP','Hpp3lPP','Hpp3lPPR','Hpp4l','Hpp4lR','HppAP','HppPP','HppPPR','HppComb']
 modes = ['ee100','em100','et100','mm100','mt100','tt100','BP1','BP2','BP3','BP4']
 masses = [200,300,400,500,600,700,800,900,1000,1100,1200,1300,1400,1500]
-modes = ['mm100']
-#masses = [200]
-unc = {}
-for mode in modes:
-    unc[mode] = {}
-    for mass in masses:
-        unc[mode][mass] = getCardUncertainties('HppComb',mode,mass)
 
-    keys = sorted(unc[mode][200].keys())
+def uncertaintiesWrapper(args):
+    analysis, mode, mass = args
+    return analysis, mode, mass, getCardUncertainties(analysis,mode,mass)
+
+def printUncertainties(unc,mode,masses):
+    keys = sorted(unc[masses[0]].keys())
 
     print ' '.join(['{0:10}'.format(k) for k in [mode]+keys])
     for mass in masses:
-        print ' '.join(['{0:10}'.format(x) for x in [mass]+['{0:10.4}'.format(unc[mode][mass][k]*100.) for k in keys]])
+        print ' '.join(['{0:10}'.format(x) for x in [mass]+['{0:10.4}'.format(unc[mass][k]*100.) for k in keys]])
     print ''
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description='Print the uncertainties in workspaces')
+
+    parser.add_argument('-a','--analyses', nargs='+',type=str,default=['HppComb'],choices=analyses,help='Analyses to process')
+    parser.add_argument('-bp','--modes', nargs='+',type=str,default=['mm100'],choices=modes,help='Branching points to process')
+    parser.add_argument('-m','--masses', nargs='+',type=int,default=masses,help='Masses to process')
+    parser.add_argument('-j',type=int,default=1,help='Number of cores')
+
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    tasks = []
+    unc = {}
+    for analysis in args.analyses:
+        unc[analysis] = {}
+        for mode in args.modes:
+            unc[analysis][mode] = {}
+            for mass in args.masses:
+                tasks += [(analysis,mode,mass)]
+
+    if args.j>1:
+        # load ROOT and combine before forking, each worker then only loads its workspaces
+        getROOT(combine=True)
+        p = Pool(args.j)
+        try:
+            results = p.map_async(uncertaintiesWrapper, tasks).get(999999)
+        except KeyboardInterrupt:
+            p.terminate()
+            print 'uncertainties cancelled'
+            return 1
+        p.close()
+        p.join()
+    else:
+        results = [uncertaintiesWrapper(task) for task in tasks]
+
+    for analysis, mode, mass, u in results:
+        unc[analysis][mode][mass] = u
+
+    for analysis in args.analyses:
+        if len(args.analyses)>1: print analysis
+        for mode in args.modes:
+            printUncertainties(unc[analysis][mode],mode,args.masses)
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
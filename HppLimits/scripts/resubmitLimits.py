@@ -10,11 +10,82 @@ import os
 import re
 import sys
 import glob
+import time
 import argparse
+from multiprocessing.pool import ThreadPool
 from socket import gethostname
 
 
-def submit_jobid(sample, dryrun=False, verboseInfo={}):
+def find_status_file(sample):
+    """
+    Return the dag status file of the sample and its stat, or (None, None).
+    FSA ntuples and PAT tuples use a different naming convention for the
+    status dag files. Try both.
+    """
+    for name in ['dag.status', 'dag.dag.status']:
+        filename = '%s/dags/%s' % (sample, name)
+        try:
+            return filename, os.stat(filename)
+        except OSError:
+            continue
+    return None, None
+
+
+# parsed status files, keyed by filename, valid while mtime and size match
+status_cache = {}
+
+def get_dag_status(sample):
+    """
+    Status of the sample from a single pass over its dag status file.
+    Results are cached per file by mtime, so unchanged files are not reread.
+    Returns None if there is no (readable) status file.
+    """
+    filename, st = find_status_file(sample)
+    if not filename: return None
+    key = [st.st_mtime, st.st_size]
+    cached = status_cache.get(filename)
+    if cached and cached['key'] == key:
+        return cached
+    # dag2 historically matched the unquoted submitted status
+    pattern = 'STATUS_SUBMITTED' if filename.endswith('dag.dag.status') else '"STATUS_SUBMITTED"'
+    try:
+        dagStatus, nodeStatuses, endStatus, flags = scan_dag_state(filename, ['STATUS_ERROR', pattern])
+        nodeErrors = []
+        for node in nodeStatuses:
+            if 'status' in node.get('StatusDetails', ''):
+                nodeErrors.append(int(node['StatusDetails'].split()[-1]))
+        status = {
+            'key': key,
+            'file': filename,
+            'total': dagStatus.get('NodesTotal', 0),
+            'done': dagStatus.get('NodesDone', 0),
+            'queued': dagStatus.get('NodesQueued', 0),
+            'failed': dagStatus.get('NodesFailed', 0),
+            'nodeErrors': nodeErrors,
+            'errors': flags['STATUS_ERROR'],
+            'submitted': flags[pattern],
+        }
+    except (IOError, ValueError, KeyError, IndexError):
+        # missing or partially written, try again next time
+        status_cache.pop(filename, None)
+        return None
+    status_cache[filename] = status
+    return status
+
+def get_dag_statuses(samples, jobs=8):
+    """Read the status of all samples concurrently, returns {sample: status}"""
+    if jobs > 1 and len(samples) > 1:
+        pool = ThreadPool(min(jobs, len(samples)))
+        try:
+            statuses = pool.map(get_dag_status, samples)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        statuses = [get_dag_status(s) for s in samples]
+    return dict(zip(samples, statuses))
+
+def submit_jobid(sample, dryrun=False, verboseInfo={}, status=None):
     """
     Check the dag status file of the sample for failed jobs. If any, submit 
     the rescue dag files to farmoutAnalysisJobs. 
@@ -22,39 +93,23 @@ def submit_jobid(sample, dryrun=False, verboseInfo={}):
     """
     verbose = bool(verboseInfo)
 
-    # FSA ntuples and PAT tuples use a different naming convention for the
-    # status dag files. Try both.
-    status_dag1 = '%s/dags/dag.status' % sample
-    status_dag2 = '%s/dags/dag.dag.status' % sample
-
     # look for failed jobs
-    errors = []
-    try:
-        if verbose: dagStatus, nodeStatuses, endStatus = parse_dag_state(status_dag1)
-        with open(status_dag1, 'r') as dagfile:
-            errors = [re.search('STATUS_ERROR', line) for line in dagfile]
-        with open(status_dag1, 'r') as dagfile:
-            submitted = [re.search('"STATUS_SUBMITTED"', line) for line in dagfile]
-    except IOError:
-        try:
-            if verbose: dagStatus, nodeStatuses, endStatus = parse_dag_state(status_dag2)
-            with open(status_dag2, 'r') as dagfile:
-                errors = [re.search('STATUS_ERROR', line) for line in dagfile]
-            with open(status_dag2, 'r') as dagfile:
-                submitted = [re.search('STATUS_SUBMITTED', line) for line in dagfile]
-        except IOError:
-            print "    Skipping: %s" % sample
-            return
+    if status is None: status = get_dag_status(sample)
+    if status is None:
+        print "    Skipping: %s" % sample
+        return
+    errors = [status['errors']]
+    submitted = [status['submitted']]
 
     # verbose details
     if verbose:
-        total = dagStatus['NodesTotal']
+        total = status['total']
         verboseInfo["jobTotal"] += total
-        done = dagStatus['NodesDone']
+        done = status['done']
         verboseInfo["jobDone"] += done
-        queued = dagStatus['NodesQueued']
+        queued = status['queued']
         verboseInfo["jobQueued"] += queued
-        failed = dagStatus['NodesFailed']
+        failed = status['failed']
         verboseInfo["jobFailed"] += failed
         if not queued and failed:
             verboseInfo["doneTotal"] += total
@@ -63,12 +118,9 @@ def submit_jobid(sample, dryrun=False, verboseInfo={}):
             verboseInfo["doneFailed"] += failed
             verboseInfo["doneSamples"] += [sample]
         statusString = "        Total: {0} Done: {1} Queued: {2} Failed: {3}".format(total,done,queued,failed)
-        errors = []
-        for node in nodeStatuses:
-            if 'status' in node['StatusDetails']:
-                errors.append(int(node['StatusDetails'].split()[-1]))
-        verboseInfo["jobErrors"].extend(errors)
-        counts = [[x,errors.count(x)] for x in set(errors)]
+        nodeErrors = status['nodeErrors']
+        verboseInfo["jobErrors"].extend(nodeErrors)
+        counts = [[x,nodeErrors.count(x)] for x in set(nodeErrors)]
         counts = sorted(counts, key=lambda error: error[0])
         #statusString += "\n        Errors:"
         #for c in counts:
@@ -95,42 +147,53 @@ def submit_jobid(sample, dryrun=False, verboseInfo={}):
 
 
 def parse_dag_state(filename):
-    with open(filename,'r') as dagfile:
-        lines = dagfile.readlines()
+    dagStatus, nodeStatuses, endStatus, flags = scan_dag_state(filename)
+    return dagStatus, nodeStatuses, endStatus
+
+def scan_dag_state(filename, patterns=[]):
+    """
+    Parse a dag status file in a single pass.
+    Also returns {pattern: bool} for whether each pattern appears in any
+    line (including the comments dropped by the parser).
+    """
     dagStatus = {}
     nodeStatuses = []
     endStatus = {}
     currentNode = {}
     keyvalString = ''
-    for line in lines:
-        if '[' in line: # new object
-            currentNode = {}
-        elif ']' in line: # end object
-            if currentNode['Type'] == "DagStatus":
-                dagStatus = currentNode
-            elif currentNode['Type'] == "NodeStatus":
-                nodeStatuses.append(currentNode)
-            elif currentNode['Type'] == "StatusEnd":
-                endStatus = currentNode
+    flags = dict([(p, False) for p in patterns])
+    with open(filename,'r') as dagfile:
+        for line in dagfile:
+            for p in patterns:
+                if not flags[p] and p in line: flags[p] = True
+            if '[' in line: # new object
+                currentNode = {}
+            elif ']' in line: # end object
+                if currentNode['Type'] == "DagStatus":
+                    dagStatus = currentNode
+                elif currentNode['Type'] == "NodeStatus":
+                    nodeStatuses.append(currentNode)
+                elif currentNode['Type'] == "StatusEnd":
+                    endStatus = currentNode
+                else:
+                    print 'Error: unknown type "%s"' % currentNode['Type']
+            elif ';' in line: # end of key val pair
+                keyvalString += line
+                keyvalString = ' '.join(keyvalString.split())
+                keyval = keyvalString.split(';')[0]
+                strings = [x.strip() for x in keyval.split('=')]
+                key = strings[0]
+                if '{' in strings[1]: # create a python list
+                    val = [x.strip('') for x in strings[1].strip('{}').split('"') if x]
+                elif '"' in strings[1]: # its a python string
+                    val = strings[1].strip('"')
+                else: # its a number
+                    val =  int(strings[1]) 
+                currentNode[key] = val
+                keyvalString = ''
             else:
-                print 'Error: unknown type "%s"' % currentNode['Type']
-        elif ';' in line: # end of key val pair
-            keyvalString += line
-            keyvalString = ' '.join(keyvalString.split())
-            keyval = keyvalString.split(';')[0]
-            strings = [x.strip() for x in keyval.split('=')]
-            key = strings[0]
-            if '{' in strings[1]: # create a python list
-                val = [x.strip('') for x in strings[1].strip('{}').split('"') if x]
-            elif '"' in strings[1]: # its a python string
-                val = strings[1].strip('"')
-            else: # its a number
-                val =  int(strings[1]) 
-            currentNode[key] = val
-            keyvalString = ''
-        else:
-            keyvalString += line
-    return dagStatus, nodeStatuses, endStatus
+                keyvalString += line
+    return dagStatus, nodeStatuses, endStatus, flags
 
 def parse_command_line(argv):
     parser = argparse.ArgumentParser(description='Resubmit failed Condor jobs',
@@ -142,6 +205,12 @@ def parse_command_line(argv):
                         help='Show samples to submit without submitting them')
     parser.add_argument('--verbose', dest='verbose', action='store_true',
                         help='Show detailed information about the jobs')
+    parser.add_argument('-j', dest='jobs', type=int, default=8,
+                        help='Number of status files to read concurrently')
+    parser.add_argument('--watch', dest='watch', nargs='?', type=int, const=60, default=0,
+                        help='Only monitor the jobs, updating the status table every WATCH seconds (default 60)')
+    parser.add_argument('--maxMissing', dest='maxMissing', type=int, default=10,
+                        help='Polls to wait for the status file of a sample before ignoring it in --watch')
 
     args = parser.parse_args(argv)
 
@@ -175,13 +244,64 @@ def generate_submit_dirs(jobids):
     return dirs
 
 
+def status_table(groups, statuses):
+    """Aggregate Done/Queued/Failed table for groups of (name, samples), Missing counts samples without a status file"""
+    rowFormat = '{0:<60} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8}'
+    lines = [rowFormat.format('Jobs', 'Samples', 'Missing', 'Total', 'Done', 'Queued', 'Failed')]
+    allTotals = [0, 0, 0, 0, 0, 0]
+    for name, samples in groups:
+        found = [statuses[s] for s in samples if statuses.get(s)]
+        totals = [len(samples), len(samples)-len(found)] + [sum([st[k] for st in found]) for k in ['total', 'done', 'queued', 'failed']]
+        allTotals = [x+y for x, y in zip(allTotals, totals)]
+        lines.append(rowFormat.format(name[-60:], *totals))
+    lines.append(rowFormat.format('All', *allTotals))
+    return '\n'.join(lines)
+
+def watch(jobids, interval=60, jobs=8, maxMissing=10):
+    """
+    Poll the status files and print the aggregate status table, until all
+    DAGs have finished. Unchanged status files are not reparsed. Samples
+    without a status file (dry runs, failed submissions) are waited for
+    for maxMissing polls and are then ignored.
+    """
+    missing = {}
+    while True:
+        groups = [(job, generate_submit_dirs([job])) for job in jobids]
+        samples = [s for name, ss in groups for s in ss]
+        before = dict([(f, st['key']) for f, st in status_cache.items()])
+        statuses = get_dag_statuses(samples, jobs=jobs)
+        changed = len([st for st in statuses.values() if st and before.get(st['file']) != st['key']])
+        print time.strftime('%Y-%m-%d %H:%M:%S'), '({0} of {1} status files changed)'.format(changed, len(samples))
+        print status_table(groups, statuses)
+        for s in samples:
+            missing[s] = 0 if statuses[s] else missing.get(s, 0)+1
+        running = [s for s in samples if (not statuses[s] and missing[s] < maxMissing) or (statuses[s] and (statuses[s]['submitted'] or statuses[s]['queued']))]
+        if not running:
+            lost = [s for s in samples if not statuses[s]]
+            if lost:
+                print "    All DAGs finished, {0} samples without a status file:".format(len(lost))
+                for s in lost: print "        {0}".format(s)
+            else:
+                print "    All DAGs finished"
+            return
+        time.sleep(interval)
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
 
     args = parse_command_line(argv)
 
+    if args.watch:
+        try:
+            watch(args.jobids, interval=args.watch, jobs=args.jobs, maxMissing=args.maxMissing)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
     samples = generate_submit_dirs(args.jobids)
+    statuses = get_dag_statuses(samples, jobs=args.jobs)
 
     verboseInfo = {}
     if args.verbose:
@@ -197,7 +317,7 @@ def main(argv=None):
         verboseInfo["doneSamples"] = []
 
     for s in samples:
-        submit_jobid(s, dryrun=args.dryrun, verboseInfo=verboseInfo)
+        submit_jobid(s, dryrun=args.dryrun, verboseInfo=verboseInfo, status=statuses[s])
 
     if args.verbose:
         statusString = "    Job Total: {0} Done: {1} Queued: {2} Failed: {3}".format(verboseInfo["jobTotal"],
@@ -0,0 +1,28 @@
+'''
+Lazy access to PyROOT and the combine library.
+
+Importing ROOT and loading libHiggsAnalysisCombinedLimit takes seconds, so
+the scripts only do it on the code paths that read trees or workspaces:
+
+    from rootLoader import getROOT
+    ROOT = getROOT(combine=True)
+
+Calling it in the parent before a multiprocessing Pool is created lets the
+forked workers inherit the initialised interpreter instead of loading it again.
+'''
+
+_ROOT = None
+_combineLoaded = False
+
+def getROOT(combine=False):
+    '''Import ROOT (and load the combine library) once per process'''
+    global _ROOT, _combineLoaded
+    if _ROOT is None:
+        import ROOT
+        # keep ROOT from parsing the command line of the script
+        ROOT.PyConfig.IgnoreCommandLineOptions = True
+        _ROOT = ROOT
+    if combine and not _combineLoaded:
+        _ROOT.gSystem.Load("libHiggsAnalysisCombinedLimit")
+        _combineLoaded = True
+    return _ROOT